@@ -1,393 +1,250 @@
 import sys
 import os
 from pathlib import Path
+from itertools import groupby
+from operator import itemgetter
 
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 os.environ.setdefault('PYTHONPATH', str(project_root))
 
 from src.models.database import engine, Base
-from sqlalchemy import text
+
+COLUMNS = [
+    ("datasets", "risk_score FLOAT DEFAULT 0.0"),
+    ("datasets", "risk_level VARCHAR DEFAULT 'low'"),
+    ("datasets", "detected_pii_types TEXT"),
+    ("datasets", "sensitive_columns TEXT"),
+    ("datasets", "requires_approval BOOLEAN DEFAULT FALSE"),
+    ("datasets", "table_name VARCHAR"),
+    ("datasets", "anchor_columns TEXT"),
+    ("shares", "approval_status VARCHAR DEFAULT 'pending'"),
+    ("shares", "revoked BOOLEAN DEFAULT FALSE"),
+    ("shares", "revoked_at TIMESTAMP"),
+    ("shares", "watermarked_table_path VARCHAR"),
+    ("shares", "is_trial BOOLEAN DEFAULT FALSE"),
+    ("shares", "trial_row_limit INTEGER"),
+    ("shares", "trial_expires_at TIMESTAMP"),
+    ("shares", "token_hash VARCHAR"),
+    ("shares", "token_rotated_at TIMESTAMP"),
+    ("shares", "profile_json TEXT"),
+    ("shares", "profile_generated_at TIMESTAMP"),
+    ("shares", "last_used_at TIMESTAMP"),
+    ("shares", "encrypted_token TEXT"),
+    ("users", "delta_sharing_server_url VARCHAR"),
+    ("users", "public_key TEXT"),
+    ("audit_logs", "predicates_requested TEXT"),
+    ("audit_logs", "predicates_applied TEXT"),
+    ("audit_logs", "predicates_applied_count INTEGER"),
+    ("audit_logs", "anchor_columns_used TEXT"),
+    ("audit_logs", "columns_returned TEXT"),
+    ("audit_logs", "bytes_served INTEGER"),
+    ("audit_logs", "client_metadata TEXT"),
+]
+
+ALTER_ACTIONS = [
+    ("datasets", "DROP COLUMN IF EXISTS s3_endpoint_id"),
+    ("shares", "ALTER COLUMN token DROP NOT NULL"),
+]
+
+CREATE_TABLES = [
+    ("audit_logs", """
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id SERIAL PRIMARY KEY,
+            buyer_id INTEGER NOT NULL REFERENCES users(id),
+            dataset_id INTEGER NOT NULL REFERENCES datasets(id),
+            share_id INTEGER NOT NULL REFERENCES shares(id),
+            query_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            columns_requested TEXT,
+            row_count_returned INTEGER DEFAULT 0,
+            query_limit INTEGER,
+            predicates_requested TEXT,
+            predicates_applied TEXT,
+            predicates_applied_count INTEGER,
+            anchor_columns_used TEXT,
+            columns_returned TEXT,
+            ip_address VARCHAR,
+            bytes_served INTEGER,
+            client_metadata TEXT
+        )
+    """),
+    ("query_rate_limits", """
+        CREATE TABLE IF NOT EXISTS query_rate_limits (
+            id SERIAL PRIMARY KEY,
+            buyer_id INTEGER NOT NULL REFERENCES users(id),
+            dataset_id INTEGER NOT NULL REFERENCES datasets(id),
+            query_count INTEGER DEFAULT 0,
+            window_start TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            window_type VARCHAR DEFAULT 'hour'
+        )
+    """),
+]
+
+UNIQUE_PURCHASED_SHARE_INDEX_LABEL = "Created unique index on purchased shares per buyer"
+
+DUPLICATE_PURCHASED_SHARES_SQL = """
+    SELECT dataset_id, buyer_id, array_agg(id ORDER BY id)
+    FROM shares
+    WHERE is_trial = FALSE
+    GROUP BY dataset_id, buyer_id
+    HAVING COUNT(*) > 1
+"""
+
+POST_STATEMENTS = [
+    ("Created index on token_hash", """
+        CREATE INDEX IF NOT EXISTS idx_shares_token_hash ON shares(token_hash)
+    """),
+    (UNIQUE_PURCHASED_SHARE_INDEX_LABEL, """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_share_dataset_buyer ON shares(dataset_id, buyer_id) WHERE is_trial = FALSE
+    """),
+    ("Created index on shares(dataset_id, buyer_id, is_trial, revoked)", """
+        CREATE INDEX IF NOT EXISTS idx_shares_dataset_buyer_trial ON shares(dataset_id, buyer_id, is_trial, revoked)
+    """),
+    ("Created dataset listing indexes", """
+        CREATE INDEX IF NOT EXISTS idx_datasets_is_public_seller_id ON datasets(is_public, seller_id);
+        CREATE INDEX IF NOT EXISTS idx_datasets_seller_id ON datasets(seller_id)
+    """),
+    ("Created share pagination indexes", """
+        CREATE INDEX IF NOT EXISTS idx_shares_buyer_id_id ON shares(buyer_id, id);
+        CREATE INDEX IF NOT EXISTS idx_shares_seller_id_id ON shares(seller_id, id)
+    """),
+    ("Created index on audit_logs(share_id, query_time)", """
+        CREATE INDEX IF NOT EXISTS idx_audit_logs_share_query_time ON audit_logs(share_id, query_time DESC)
+    """),
+    ("Migrated existing tokens to hashes (if applicable)", """
+        DO $$ 
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns 
+                       WHERE table_name='shares' AND column_name='token' 
+                       AND column_name='token_hash' IS NULL) THEN
+                UPDATE shares 
+                SET token_hash = encode(sha256(token::bytea), 'hex')
+                WHERE token_hash IS NULL AND token IS NOT NULL;
+            END IF;
+        END $$
+    """),
+]
+
+BACKFILL_BATCH_SIZE = 5000
+
+BACKFILL_TABLE_NAME_SQL = f"""
+    UPDATE datasets 
+    SET table_name = name 
+    WHERE id IN (
+        SELECT id FROM datasets 
+        WHERE table_name IS NULL 
+        LIMIT {BACKFILL_BATCH_SIZE}
+    )
+"""
+
+def alter_statement(table: str, actions: list) -> str:
+    return f"ALTER TABLE {table} " + ", ".join(actions)
+
+def find_missing_tables(conn) -> set:
+    tables = [table for table, _ in CREATE_TABLES]
+    row = conn.exec_driver_sql(
+        "SELECT " + ", ".join(f"to_regclass('{table}')" for table in tables)
+    ).first()
+    return {table for table, regclass in zip(tables, row) if regclass is None}
+
+def find_duplicate_purchased_shares(conn) -> list:
+    for sql in (DUPLICATE_PURCHASED_SHARES_SQL, DUPLICATE_PURCHASED_SHARES_SQL.replace("WHERE is_trial = FALSE", "")):
+        savepoint = conn.begin_nested()
+        try:
+            rows = conn.exec_driver_sql(sql).fetchall()
+            savepoint.commit()
+            return rows
+        except Exception:
+            savepoint.rollback()
+    return []
+
+def build_migration_steps(missing_tables: set = frozenset(), skipped_labels: set = frozenset()) -> list:
+    steps = [(f"Created {table} table", sql, None) for table, sql in CREATE_TABLES]
+    
+    actions = [(table, f"ADD COLUMN IF NOT EXISTS {column_def}") for table, column_def in COLUMNS] + ALTER_ACTIONS
+    actions = [(table, action) for table, action in actions if table not in missing_tables]
+    for table, group in groupby(sorted(actions, key=itemgetter(0)), key=itemgetter(0)):
+        table_actions = [action for _, action in group]
+        steps.append((
+            f"Applied {len(table_actions)} column changes to {table}",
+            alter_statement(table, table_actions),
+            [alter_statement(table, [action]) for action in table_actions]
+        ))
+    
+    steps.extend((label, sql, None) for label, sql in POST_STATEMENTS if label not in skipped_labels)
+    return steps
+
+def execute_in_savepoint(conn, sql: str):
+    savepoint = conn.begin_nested()
+    try:
+        conn.exec_driver_sql(sql)
+        savepoint.commit()
+    except Exception:
+        savepoint.rollback()
+        raise
+
+def execute_as_single_round_trip(conn, steps: list, messages: list) -> bool:
+    script = ";\n".join(sql for _, sql, _ in steps) + ";"
+    try:
+        execute_in_savepoint(conn, script)
+    except Exception as e:
+        messages.append(f"Single round-trip migration failed, falling back to per-statement execution: {e}")
+        return False
+    messages.extend(label for label, _, _ in steps)
+    return True
+
+def execute_step(conn, label: str, sql: str, messages: list, per_statement_fallback: list = None):
+    try:
+        execute_in_savepoint(conn, sql)
+        messages.append(label)
+    except Exception as e:
+        messages.append(f"{label} failed: {e}")
+        for statement in per_statement_fallback or []:
+            try:
+                execute_in_savepoint(conn, statement)
+                messages.append(f"  {statement}")
+            except Exception as statement_error:
+                messages.append(f"  {statement}: {statement_error}")
+
+def backfill_table_names() -> int:
+    total_updated = 0
+    while True:
+        with engine.begin() as conn:
+            updated = conn.exec_driver_sql(BACKFILL_TABLE_NAME_SQL).rowcount
+        if updated <= 0:
+            break
+        total_updated += updated
+    return total_updated
 
 def migrate_database():
-    print("Migrating database to add privacy features, approval workflows, and usage logging...")
+    messages = ["Migrating database to add privacy features, approval workflows, and usage logging..."]
     
-    with engine.connect() as conn:
-        try:
-            conn.execute(text("""
-                ALTER TABLE datasets 
-                ADD COLUMN IF NOT EXISTS risk_score FLOAT DEFAULT 0.0;
-            """))
-            print("Added risk_score column")
-        except Exception as e:
-            print(f"risk_score column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE datasets 
-                ADD COLUMN IF NOT EXISTS risk_level VARCHAR DEFAULT 'low';
-            """))
-            print("Added risk_level column")
-        except Exception as e:
-            print(f"risk_level column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE datasets 
-                ADD COLUMN IF NOT EXISTS detected_pii_types TEXT;
-            """))
-            print("Added detected_pii_types column")
-        except Exception as e:
-            print(f"detected_pii_types column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE datasets 
-                ADD COLUMN IF NOT EXISTS sensitive_columns TEXT;
-            """))
-            print("Added sensitive_columns column")
-        except Exception as e:
-            print(f"sensitive_columns column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE datasets 
-                ADD COLUMN IF NOT EXISTS requires_approval BOOLEAN DEFAULT FALSE;
-            """))
-            print("Added requires_approval column")
-        except Exception as e:
-            print(f"requires_approval column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS approval_status VARCHAR DEFAULT 'pending';
-            """))
-            print("Added approval_status column to shares")
-        except Exception as e:
-            print(f"approval_status column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS revoked BOOLEAN DEFAULT FALSE;
-            """))
-            print("Added revoked column to shares")
-        except Exception as e:
-            print(f"revoked column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS revoked_at TIMESTAMP;
-            """))
-            print("Added revoked_at column to shares")
-        except Exception as e:
-            print(f"revoked_at column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS watermarked_table_path VARCHAR;
-            """))
-            print("Added watermarked_table_path column to shares")
-        except Exception as e:
-            print(f"watermarked_table_path column: {e}")
-        
-        try:
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS audit_logs (
-                    id SERIAL PRIMARY KEY,
-                    buyer_id INTEGER NOT NULL REFERENCES users(id),
-                    dataset_id INTEGER NOT NULL REFERENCES datasets(id),
-                    share_id INTEGER NOT NULL REFERENCES shares(id),
-                    query_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    columns_requested TEXT,
-                    row_count_returned INTEGER DEFAULT 0,
-                    query_limit INTEGER,
-                    predicates_requested TEXT,
-                    predicates_applied TEXT,
-                    predicates_applied_count INTEGER,
-                    ip_address VARCHAR
-                );
-            """))
-            print("Created audit_logs table")
-        except Exception as e:
-            print(f"audit_logs table: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE audit_logs 
-                ADD COLUMN IF NOT EXISTS predicates_requested TEXT;
-            """))
-            print("Added predicates_requested column to audit_logs")
-        except Exception as e:
-            print(f"predicates_requested column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE audit_logs 
-                ADD COLUMN IF NOT EXISTS predicates_applied TEXT;
-            """))
-            print("Added predicates_applied column to audit_logs")
-        except Exception as e:
-            print(f"predicates_applied column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE audit_logs 
-                ADD COLUMN IF NOT EXISTS predicates_applied_count INTEGER;
-            """))
-            print("Added predicates_applied_count column to audit_logs")
-        except Exception as e:
-            print(f"predicates_applied_count column: {e}")
-        
-        try:
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS query_rate_limits (
-                    id SERIAL PRIMARY KEY,
-                    buyer_id INTEGER NOT NULL REFERENCES users(id),
-                    dataset_id INTEGER NOT NULL REFERENCES datasets(id),
-                    query_count INTEGER DEFAULT 0,
-                    window_start TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    window_type VARCHAR DEFAULT 'hour'
-                );
-            """))
-            print("Created query_rate_limits table")
-        except Exception as e:
-            print(f"query_rate_limits table: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE users 
-                ADD COLUMN IF NOT EXISTS delta_sharing_server_url VARCHAR;
-            """))
-            print("Added delta_sharing_server_url column to users")
-        except Exception as e:
-            print(f"delta_sharing_server_url column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE datasets 
-                DROP COLUMN IF EXISTS s3_endpoint_id;
-            """))
-            print("Removed s3_endpoint_id column from datasets")
-        except Exception as e:
-            print(f"s3_endpoint_id column removal: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS is_trial BOOLEAN DEFAULT FALSE;
-            """))
-            print("Added is_trial column to shares")
-        except Exception as e:
-            print(f"is_trial column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS trial_row_limit INTEGER;
-            """))
-            print("Added trial_row_limit column to shares")
-        except Exception as e:
-            print(f"trial_row_limit column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS trial_expires_at TIMESTAMP;
-            """))
-            print("Added trial_expires_at column to shares")
-        except Exception as e:
-            print(f"trial_expires_at column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE datasets 
-                ADD COLUMN IF NOT EXISTS table_name VARCHAR;
-            """))
-            print("Added table_name column to datasets")
-            conn.execute(text("""
-                UPDATE datasets 
-                SET table_name = name 
-                WHERE table_name IS NULL;
-            """))
-            print("Populated table_name with name values for existing datasets")
-        except Exception as e:
-            print(f"table_name column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE datasets 
-                ADD COLUMN IF NOT EXISTS anchor_columns TEXT;
-            """))
-            print("Added anchor_columns column to datasets")
-        except Exception as e:
-            print(f"anchor_columns column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE audit_logs 
-                ADD COLUMN IF NOT EXISTS anchor_columns_used TEXT;
-            """))
-            print("Added anchor_columns_used column to audit_logs")
-        except Exception as e:
-            print(f"anchor_columns_used column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE audit_logs 
-                ADD COLUMN IF NOT EXISTS columns_returned TEXT;
-            """))
-            print("Added columns_returned column to audit_logs")
-        except Exception as e:
-            print(f"columns_returned column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE audit_logs 
-                ADD COLUMN IF NOT EXISTS bytes_served INTEGER;
-            """))
-            print("Added bytes_served column to audit_logs")
-        except Exception as e:
-            print(f"bytes_served column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE audit_logs 
-                ADD COLUMN IF NOT EXISTS client_metadata TEXT;
-            """))
-            print("Added client_metadata column to audit_logs")
-        except Exception as e:
-            print(f"client_metadata column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS token_hash VARCHAR;
-            """))
-            print("Added token_hash column to shares")
-        except Exception as e:
-            print(f"token_hash column: {e}")
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS token_rotated_at TIMESTAMP;
-            """))
-            print("Added token_rotated_at column to shares")
-        except Exception as e:
-            print(f"token_rotated_at column: {e}")
-        
-        try:
-            conn.execute(text("""
-                CREATE INDEX IF NOT EXISTS idx_shares_token_hash ON shares(token_hash);
-            """))
-            print("Created index on token_hash")
-        except Exception as e:
-            print(f"token_hash index: {e}")
-        
-        try:
-            conn.execute(text("""
-                DO $$ 
-                BEGIN
-                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns 
-                                   WHERE table_name='shares' AND column_name='profile_json') THEN
-                        ALTER TABLE shares ADD COLUMN profile_json TEXT;
-                    END IF;
-                END $$;
-            """))
-            print("Added profile_json column to shares")
-            conn.commit()
-        except Exception as e:
-            print(f"profile_json column: {e}")
-            conn.rollback()
-        
-        try:
-            conn.execute(text("""
-                DO $$ 
-                BEGIN
-                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns 
-                                   WHERE table_name='shares' AND column_name='profile_generated_at') THEN
-                        ALTER TABLE shares ADD COLUMN profile_generated_at TIMESTAMP;
-                    END IF;
-                END $$;
-            """))
-            print("Added profile_generated_at column to shares")
-            conn.commit()
-        except Exception as e:
-            print(f"profile_generated_at column: {e}")
-            conn.rollback()
-        
-        try:
-            conn.execute(text("""
-                DO $$ 
-                BEGIN
-                    IF EXISTS (SELECT 1 FROM information_schema.columns 
-                               WHERE table_name='shares' AND column_name='token' 
-                               AND column_name='token_hash' IS NULL) THEN
-                        UPDATE shares 
-                        SET token_hash = encode(sha256(token::bytea), 'hex')
-                        WHERE token_hash IS NULL AND token IS NOT NULL;
-                    END IF;
-                END $$;
-            """))
-            print("Migrated existing tokens to hashes (if applicable)")
-            conn.commit()
-        except Exception as e:
-            print(f"Token migration: {e}")
-            conn.rollback()
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS last_used_at TIMESTAMP;
-            """))
-            print("Added last_used_at column to shares")
-            conn.commit()
-        except Exception as e:
-            print(f"last_used_at column: {e}")
-            conn.rollback()
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE users 
-                ADD COLUMN IF NOT EXISTS public_key TEXT;
-            """))
-            print("Added public_key column to users")
-            conn.commit()
-        except Exception as e:
-            print(f"public_key column: {e}")
-            conn.rollback()
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ADD COLUMN IF NOT EXISTS encrypted_token TEXT;
-            """))
-            print("Added encrypted_token column to shares")
-            conn.commit()
-        except Exception as e:
-            print(f"encrypted_token column: {e}")
-            conn.rollback()
-        
-        try:
-            conn.execute(text("""
-                ALTER TABLE shares 
-                ALTER COLUMN token DROP NOT NULL;
-            """))
-            print("Made token column nullable")
-            conn.commit()
-        except Exception as e:
-            print(f"token nullable: {e}")
-            conn.rollback()
-        
-        print("\nDatabase migration completed!")
-        print("Note: If columns already exist, you may see errors above. This is normal.")
-        print("Note: S3 credentials are now seller-side (environment variables), not in marketplace database.")
-        print("Note: Tokens are now hashed. Old plaintext tokens will be migrated on first use.")
+    try:
+        with engine.begin() as conn:
+            skipped_labels = set()
+            duplicates = find_duplicate_purchased_shares(conn)
+            if duplicates:
+                skipped_labels.add(UNIQUE_PURCHASED_SHARE_INDEX_LABEL)
+                messages.append(f"Skipped uq_share_dataset_buyer: {len(duplicates)} (dataset_id, buyer_id) pairs have more than one non-trial share. Resolve them and rerun:")
+                messages.extend(f"  dataset_id={dataset_id} buyer_id={buyer_id} share_ids={share_ids}" for dataset_id, buyer_id, share_ids in duplicates)
+            steps = build_migration_steps(find_missing_tables(conn), skipped_labels)
+            if not execute_as_single_round_trip(conn, steps, messages):
+                for label, sql, per_statement_fallback in steps:
+                    execute_step(conn, label, sql, messages, per_statement_fallback)
+        
+        try:
+            updated = backfill_table_names()
+            messages.append(f"Populated table_name with name values for {updated} existing datasets")
+        except Exception as e:
+            messages.append(f"table_name backfill: {e}")
+        
+        messages.append("\nDatabase migration completed!")
+        messages.append("Note: If columns already exist, you may see errors above. This is normal.")
+        messages.append("Note: S3 credentials are now seller-side (environment variables), not in marketplace database.")
+        messages.append("Note: Tokens are now hashed. Old plaintext tokens will be migrated on first use.")
+    finally:
+        sys.stdout.write("\n".join(messages) + "\n")
+        sys.stdout.flush()
 
 if __name__ == "__main__":
     migrate_database()
-
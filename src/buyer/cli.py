@@ -4,16 +4,20 @@ import argparse
 import json
 import tempfile
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 from typing import Optional
-from delta_sharing import SharingClient, load_as_pandas
-from delta_sharing.protocol import DeltaSharingProfile
 
 MARKETPLACE_URL = os.getenv("MARKETPLACE_URL", "http://localhost:8000")
 DELTA_SHARING_SERVER_URL = os.getenv("DELTA_SHARING_SERVER_URL", "http://localhost:8080")
 
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+HTTP_SESSION.headers.update({"Connection": "keep-alive"})
+
 def register_user(email: str, password: str, role: str = "buyer") -> dict:
-    response = requests.post(
+    response = HTTP_SESSION.post(
         f"{MARKETPLACE_URL}/register",
         json={"email": email, "password": password, "role": role}
     )
@@ -21,7 +25,7 @@ def register_user(email: str, password: str, role: str = "buyer") -> dict:
     return response.json()
 
 def login(email: str, password: str) -> str:
-    response = requests.post(
+    response = HTTP_SESSION.post(
         f"{MARKETPLACE_URL}/login",
         json={"email": email, "password": password}
     )
@@ -30,19 +34,19 @@ def login(email: str, password: str) -> str:
 
 def list_datasets(token: str) -> list:
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{MARKETPLACE_URL}/datasets", headers=headers)
+    response = HTTP_SESSION.get(f"{MARKETPLACE_URL}/datasets", headers=headers)
     response.raise_for_status()
     return response.json()
 
 def purchase_dataset(dataset_id: int, token: str) -> dict:
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.post(f"{MARKETPLACE_URL}/purchase/{dataset_id}", headers=headers)
+    response = HTTP_SESSION.post(f"{MARKETPLACE_URL}/purchase/{dataset_id}", headers=headers)
     response.raise_for_status()
     return response.json()
 
 def request_trial(dataset_id: int, token: str, row_limit: int = 100, days_valid: int = 7) -> dict:
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.post(
+    response = HTTP_SESSION.post(
         f"{MARKETPLACE_URL}/datasets/{dataset_id}/trial",
         json={"row_limit": row_limit, "days_valid": days_valid},
         headers=headers
@@ -52,17 +56,60 @@ def request_trial(dataset_id: int, token: str, row_limit: int = 100, days_valid:
 
 def get_profile(share_id: int, token: str) -> dict:
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{MARKETPLACE_URL}/shares/{share_id}/profile", headers=headers)
+    response = HTTP_SESSION.get(f"{MARKETPLACE_URL}/shares/{share_id}/profile", headers=headers)
     response.raise_for_status()
     return response.json()
 
 def save_profile(profile_data: dict, output_path: str):
-    profile_json = json.loads(profile_data["profile_json"])
-    with open(output_path, 'w') as f:
-        json.dump(profile_json, f, indent=2)
+    Path(output_path).write_text(profile_data["profile_json"])
     print(f"Profile saved to {output_path}")
 
+SAMPLE_ROWS = 10
+WATERMARK_SAMPLE_ROWS = 10000
+
+def query_table_arrow(profile_path: str, share_name: str, schema_name: str, table_name: str, limit: Optional[int] = None) -> dict:
+    import fsspec
+    import pyarrow.parquet as pq
+    from delta_sharing.protocol import DeltaSharingProfile, Table
+    from delta_sharing.rest_client import DeltaSharingRestClient
+    
+    profile = DeltaSharingProfile.read_from_file(profile_path)
+    rest_client = DeltaSharingRestClient(profile)
+    response = rest_client.list_files_in_table(
+        Table(name=table_name, share=share_name, schema=schema_name),
+        limitHint=limit
+    )
+    columns = [field["name"] for field in json.loads(response.metadata.schema_string)["fields"]]
+    
+    total_rows = 0
+    sample = []
+    for add_file in response.add_files:
+        with fsspec.open(add_file.url, "rb") as f:
+            parquet_file = pq.ParquetFile(f)
+            total_rows += parquet_file.metadata.num_rows
+            if len(sample) < SAMPLE_ROWS and parquet_file.metadata.num_rows > 0:
+                batch = next(parquet_file.iter_batches(batch_size=SAMPLE_ROWS - len(sample)))
+                sample.extend(batch.to_pylist())
+    
+    if limit is not None:
+        total_rows = min(total_rows, limit)
+        sample = sample[:limit]
+    
+    return {
+        "success": True,
+        "rows": total_rows,
+        "columns": columns,
+        "data": sample
+    }
+
 def query_table(profile_path: str, share_name: str, schema_name: str, table_name: str, limit: Optional[int] = None) -> dict:
+    try:
+        return query_table_arrow(profile_path, share_name, schema_name, table_name, limit)
+    except Exception as e:
+        print(f"Warning: Arrow query path failed, falling back to pandas: {e}")
+    
+    from delta_sharing import load_as_pandas
+    
     table_url = f"{profile_path}#{share_name}.{schema_name}.{table_name}"
     
     try:
@@ -71,7 +118,7 @@ def query_table(profile_path: str, share_name: str, schema_name: str, table_name
             "success": True,
             "rows": len(df),
             "columns": list(df.columns),
-            "data": df.head(10).to_dict('records') if len(df) > 0 else []
+            "data": df.head(SAMPLE_ROWS).to_dict('records') if len(df) > 0 else []
         }
     except Exception as e:
         return {
@@ -80,19 +127,19 @@ def query_table(profile_path: str, share_name: str, schema_name: str, table_name
         }
 
 def verify_watermark(profile_path: str, share_name: str, schema_name: str, table_name: str, buyer_id: int, share_id: int, anchor_columns: Optional[list] = None):
-    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-    from tests.utils import check_watermark, extract_list_items
+    from delta_sharing import load_as_pandas
+    from src.buyer.watermark import check_watermark
     
     table_url = f"{profile_path}#{share_name}.{schema_name}.{table_name}"
     
     try:
-        df = load_as_pandas(table_url)
+        df = load_as_pandas(table_url, limit=WATERMARK_SAMPLE_ROWS)
         result = check_watermark(df, buyer_id, share_id, verbose=True, anchor_columns=anchor_columns)
         return result
     except Exception as e:
         return {"found": False, "error": str(e)}
 
-def main():
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Delta Sharing Buyer CLI")
     subparsers = parser.add_subparsers(dest='command', help='Available commands')
     
@@ -140,112 +187,136 @@ def main():
     verify_parser.add_argument('--share-id', type=int, required=True, help='Share ID')
     verify_parser.add_argument('--anchor-columns', help='Comma-separated anchor columns')
     
-    args = parser.parse_args()
+    return parser
+
+def require_token(token: Optional[str]) -> bool:
+    if not token:
+        print("Error: Token required. Use --token or set DELTA_SHARING_TOKEN env var")
+        return False
+    return True
+
+def cmd_register(args, token: Optional[str]):
+    result = register_user(args.email, args.password, args.role)
+    print(f"User registered: {result['email']} (ID: {result['id']})")
+
+def cmd_login(args, token: Optional[str]):
+    token = login(args.email, args.password)
+    print(f"Login successful")
+    print(f"Token: {token}")
+    if args.save_token:
+        with open(args.save_token, 'w') as f:
+            f.write(token)
+        print(f"Token saved to {args.save_token}")
+
+def cmd_list(args, token: Optional[str]):
+    if not require_token(token):
+        return
+    datasets = list_datasets(token)
+    print(f"\nAvailable datasets ({len(datasets)}):")
+    for ds in datasets:
+        print(f"  ID: {ds['id']}, Name: {ds['name']}, Price: ${ds['price']:.2f}")
+        if ds.get('risk_level'):
+            print(f"    Risk: {ds['risk_level']} ({ds.get('risk_score', 0):.1f})")
+
+def cmd_purchase(args, token: Optional[str]):
+    if not require_token(token):
+        return
+    result = purchase_dataset(args.dataset_id, token)
+    print(f"Purchase created")
+    print(f"  Share ID: {result['share_id']}")
+    print(f"  Approval Status: {result['approval_status']}")
+    if result.get('share_token'):
+        print(f"  Share Token: {result['share_token'][:20]}...")
+
+def cmd_trial(args, token: Optional[str]):
+    if not require_token(token):
+        return
+    result = request_trial(args.dataset_id, token, args.row_limit, args.days_valid)
+    print(f"Trial access granted")
+    print(f"  Share ID: {result['share_id']}")
+    print(f"  Row Limit: {result['trial_row_limit']}")
+    print(f"  Expires: {result['trial_expires_at']}")
+    if result.get('share_token'):
+        print(f"  Share Token: {result['share_token'][:20]}...")
+
+def cmd_profile(args, token: Optional[str]):
+    if not require_token(token):
+        return
+    result = get_profile(args.share_id, token)
+    save_profile(result, args.output)
+
+def cmd_query(args, token: Optional[str]):
+    result = query_table(args.profile, args.share, args.schema, args.table, args.limit)
+    if result['success']:
+        print(f"Query successful")
+        print(f"  Rows: {result['rows']}")
+        print(f"  Columns: {result['columns']}")
+        if result['data']:
+            print(f"\n  Sample data (first {min(5, len(result['data']))} rows):")
+            for i, row in enumerate(result['data'][:5]):
+                print(f"    Row {i+1}: {row}")
+    else:
+        print(f"Query failed: {result['error']}")
+
+def cmd_verify(args, token: Optional[str]):
+    anchor_cols = None
+    if args.anchor_columns:
+        anchor_cols = [col.strip() for col in args.anchor_columns.split(',')]
+    result = verify_watermark(
+        args.profile, args.share, args.schema, args.table,
+        args.buyer_id, args.share_id, anchor_cols
+    )
+    if result.get('found'):
+        print("Watermark detected")
+        if result.get('watermark_column', {}).get('found'):
+            wc = result['watermark_column']
+            print(f"  Watermark column: {wc['matches']}/{wc['checked']} matches ({wc['match_rate']:.1f}%)")
+        if result.get('timestamp', {}).get('found'):
+            ts = result['timestamp']
+            print(f"  Timestamp watermark: {ts['matches']}/{ts['checked']} matches ({ts['match_rate']:.1f}%)")
+    else:
+        print(f"Watermark not detected: {result.get('reason', 'Unknown')}")
+
+HANDLERS = {
+    'register': cmd_register,
+    'login': cmd_login,
+    'list': cmd_list,
+    'purchase': cmd_purchase,
+    'trial': cmd_trial,
+    'profile': cmd_profile,
+    'query': cmd_query,
+    'verify': cmd_verify,
+}
+
+def handle_http_error(e: requests.exceptions.HTTPError):
+    print(f"HTTP Error: {e}")
+    if hasattr(e.response, 'text'):
+        print(f"  Response: {e.response.text}")
+    sys.exit(1)
+
+def handle_error(e: Exception):
+    print(f"Error: {e}")
+    import traceback
+    traceback.print_exc()
+    sys.exit(1)
+
+PARSER = build_parser()
+
+def main(argv: Optional[list] = None):
+    args = PARSER.parse_args(argv)
     
     if not args.command:
-        parser.print_help()
+        PARSER.print_help()
         return
     
-    token = args.token or os.getenv('DELTA_SHARING_TOKEN')
+    token = getattr(args, 'token', None) or os.getenv('DELTA_SHARING_TOKEN')
     
     try:
-        if args.command == 'register':
-            result = register_user(args.email, args.password, args.role)
-            print(f"User registered: {result['email']} (ID: {result['id']})")
-        
-        elif args.command == 'login':
-            token = login(args.email, args.password)
-            print(f"Login successful")
-            print(f"Token: {token}")
-            if args.save_token:
-                with open(args.save_token, 'w') as f:
-                    f.write(token)
-                print(f"Token saved to {args.save_token}")
-        
-        elif args.command == 'list':
-            if not token:
-                print("Error: Token required. Use --token or set DELTA_SHARING_TOKEN env var")
-                return
-            datasets = list_datasets(token)
-            print(f"\nAvailable datasets ({len(datasets)}):")
-            for ds in datasets:
-                print(f"  ID: {ds['id']}, Name: {ds['name']}, Price: ${ds['price']:.2f}")
-                if ds.get('risk_level'):
-                    print(f"    Risk: {ds['risk_level']} ({ds.get('risk_score', 0):.1f})")
-        
-        elif args.command == 'purchase':
-            if not token:
-                print("Error: Token required. Use --token or set DELTA_SHARING_TOKEN env var")
-                return
-            result = purchase_dataset(args.dataset_id, token)
-            print(f"Purchase created")
-            print(f"  Share ID: {result['share_id']}")
-            print(f"  Approval Status: {result['approval_status']}")
-            if result.get('share_token'):
-                print(f"  Share Token: {result['share_token'][:20]}...")
-        
-        elif args.command == 'trial':
-            if not token:
-                print("Error: Token required. Use --token or set DELTA_SHARING_TOKEN env var")
-                return
-            result = request_trial(args.dataset_id, token, args.row_limit, args.days_valid)
-            print(f"Trial access granted")
-            print(f"  Share ID: {result['share_id']}")
-            print(f"  Row Limit: {result['trial_row_limit']}")
-            print(f"  Expires: {result['trial_expires_at']}")
-            if result.get('share_token'):
-                print(f"  Share Token: {result['share_token'][:20]}...")
-        
-        elif args.command == 'profile':
-            if not token:
-                print("Error: Token required. Use --token or set DELTA_SHARING_TOKEN env var")
-                return
-            result = get_profile(args.share_id, token)
-            save_profile(result, args.output)
-        
-        elif args.command == 'query':
-            result = query_table(args.profile, args.share, args.schema, args.table, args.limit)
-            if result['success']:
-                print(f"Query successful")
-                print(f"  Rows: {result['rows']}")
-                print(f"  Columns: {result['columns']}")
-                if result['data']:
-                    print(f"\n  Sample data (first {min(5, len(result['data']))} rows):")
-                    for i, row in enumerate(result['data'][:5]):
-                        print(f"    Row {i+1}: {row}")
-            else:
-                print(f"Query failed: {result['error']}")
-        
-        elif args.command == 'verify':
-            anchor_cols = None
-            if args.anchor_columns:
-                anchor_cols = [col.strip() for col in args.anchor_columns.split(',')]
-            result = verify_watermark(
-                args.profile, args.share, args.schema, args.table,
-                args.buyer_id, args.share_id, anchor_cols
-            )
-            if result.get('found'):
-                print("Watermark detected")
-                if result.get('watermark_column', {}).get('found'):
-                    wc = result['watermark_column']
-                    print(f"  Watermark column: {wc['matches']}/{wc['checked']} matches ({wc['match_rate']:.1f}%)")
-                if result.get('timestamp', {}).get('found'):
-                    ts = result['timestamp']
-                    print(f"  Timestamp watermark: {ts['matches']}/{ts['checked']} matches ({ts['match_rate']:.1f}%)")
-            else:
-                print(f"Watermark not detected: {result.get('reason', 'Unknown')}")
-    
+        HANDLERS[args.command](args, token)
     except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error: {e}")
-        if hasattr(e.response, 'text'):
-            print(f"  Response: {e.response.text}")
-        sys.exit(1)
+        handle_http_error(e)
     except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
-        sys.exit(1)
+        handle_error(e)
 
 if __name__ == "__main__":
     main()
-
@@ -1,14 +1,19 @@
 import os
 import sys
+from typing import Optional
 from pyspark.sql import SparkSession
 from delta.sharing import DeltaSharingClient
 
-def read_delta_sharing_table(profile_path: str, share_name: str, schema_name: str, table_name: str):
-    spark = SparkSession.builder \
+def get_spark_session() -> SparkSession:
+    return SparkSession.builder \
         .appName("DeltaSharingReader") \
         .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension") \
         .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog") \
         .getOrCreate()
+
+def read_delta_sharing_table(profile_path: str, share_name: str, schema_name: str, table_name: str, spark: Optional[SparkSession] = None):
+    if spark is None:
+        spark = get_spark_session()
     
     client = DeltaSharingClient(profile_path)
     
@@ -17,8 +22,10 @@ def read_delta_sharing_table(profile_path: str, share_name: str, schema_name: st
     print(f"Reading table: {table_path}")
     df = client.load_table(table_path)
     
+    row_count = df.count()
+    
     print(f"Table loaded successfully")
-    print(f"  Rows: {df.count()}")
+    print(f"  Rows: {row_count}")
     print(f"  Columns: {df.columns}")
     print(f"\n  Schema:")
     df.printSchema()
@@ -26,9 +33,8 @@ def read_delta_sharing_table(profile_path: str, share_name: str, schema_name: st
     print(f"\n  Sample data (first 10 rows):")
     df.show(10, truncate=False)
     
-    print(f"\n  Row count: {df.count()}")
+    print(f"\n  Row count: {row_count}")
     
-    spark.stop()
     return df
 
 if __name__ == "__main__":
@@ -41,5 +47,8 @@ if __name__ == "__main__":
     schema_name = sys.argv[3]
     table_name = sys.argv[4]
     
-    read_delta_sharing_table(profile_path, share_name, schema_name, table_name)
-
+    spark = get_spark_session()
+    try:
+        read_delta_sharing_table(profile_path, share_name, schema_name, table_name, spark=spark)
+    finally:
+        spark.stop()
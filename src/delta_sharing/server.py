@@ -1,11 +1,16 @@
 from fastapi import FastAPI, HTTPException, Header, Depends, Request
 from fastapi.responses import StreamingResponse
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from typing import Optional, Tuple
+import asyncio
+import concurrent.futures
+import multiprocessing
 import json
+import time
+import orjson
 import io
 import os
-import time
 import traceback
 from datetime import datetime, timedelta
 from deltalake import DeltaTable
@@ -14,12 +19,10 @@ import pyarrow as pa
 import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 import pandas as pd
-import tempfile
-import uuid
 from deltalake import write_deltalake
 
-from src.models.database import get_db, AuditLog, User
-from src.seller.watermarking import generate_watermark, apply_watermark_to_dataframe
+from src.models.database import get_db, SessionLocal, AuditLog, User
+from src.seller.watermarking import generate_watermark, dataset_needs_watermarking, serialize_arrow_table, encode_watermarked_parquet
 from src.seller.publish import publish_dataset_metadata
 from src.seller.synthetic_data import generate_synthetic_data
 from src.utils.delta_sharing_utils import get_share_from_token
@@ -29,26 +32,125 @@ from src.utils.encryption import encrypt_token
 from src.utils.token_utils import generate_share_token, hash_token
 from src.utils.s3_utils import (
     get_s3_client, get_delta_storage_options,
-    fix_endpoint_url_for_client, get_full_s3_path, get_bucket_name
+    get_client_endpoint, get_full_s3_path, get_bucket_name,
+    UPLOAD_TRANSFER_CONFIG
 )
 from src.utils.delta_sharing_utils import (
     extract_token_from_header, validate_share_access, get_dataset,
-    get_table_path, transform_schema_for_timestamp_ntz, get_presigned_url,
-    cleanup_old_watermarked_files, get_share_from_token
+    get_table_path, get_presigned_url,
+    ensure_watermark_cache_expiration, get_cached_share_from_token, load_table_metadata,
+    get_watermark_cache_key, head_cached_object, read_cached_parquet_columns, build_shared_schema_string, get_cached_delta_table,
+    get_cached_arrow_dataset, parse_anchor_columns, list_table_files,
+    WATERMARK_CACHE_TAG
 )
 from src.utils.predicate_parser import parse_query_predicates
 
 app = FastAPI(title="Delta Sharing Server")
 
+SCAN_BATCH_SIZE = 64 * 1024
+SCAN_FRAGMENT_READAHEAD = 8
+WATERMARK_PARQUET_COMPRESSION = "zstd"
+WATERMARK_PARQUET_COMPRESSION_LEVEL = 3
+WATERMARK_PARQUET_DATA_PAGE_SIZE = 1 << 20
+WATERMARK_PARQUET_MAX_ROW_GROUP_SIZE = 1_000_000
+WATERMARK_PROCESS_WORKERS = int(os.getenv("WATERMARK_PROCESS_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+QUERY_RESULT_CACHE_TTL_SECONDS = 3600
+QUERY_RESULT_CACHE_MAX_SIZE = 10000
+QUERY_RESULT_CACHE = {}
+QUERY_RESULT_LOCKS = {}
+WATERMARK_REQUIRED_CACHE = {}
+AUDIT_LOG_BATCH_SIZE = 500
+AUDIT_LOG_FLUSH_INTERVAL_SECONDS = 1.0
+AUDIT_LOG_STOP = object()
+
+def get_cached_query_result(cache_key: str) -> Optional[tuple]:
+    cached = QUERY_RESULT_CACHE.get(cache_key)
+    if not cached:
+        return None
+    if time.monotonic() >= cached[0]:
+        QUERY_RESULT_CACHE.pop(cache_key, None)
+        return None
+    return cached[1:]
+
+def table_needs_watermarking(table_path: str, table_version: int, arrow_dataset: ds.Dataset) -> bool:
+    cache_key = (table_path, table_version)
+    if cache_key not in WATERMARK_REQUIRED_CACHE:
+        WATERMARK_REQUIRED_CACHE[cache_key] = dataset_needs_watermarking(arrow_dataset)
+    return WATERMARK_REQUIRED_CACHE[cache_key]
+
+def load_share_and_dataset(token: str, share_name: str, db: Session) -> Tuple:
+    share = get_share_from_token(token, db)
+    validate_share_access(share_name, share)
+    return share, get_dataset(share, db)
+
+@app.on_event("startup")
+async def startup_event():
+    app.state.audit_queue = asyncio.Queue()
+    app.state.audit_flusher = asyncio.create_task(flush_audit_logs(app.state.audit_queue))
+    watermark_context = multiprocessing.get_context("forkserver")
+    watermark_context.set_forkserver_preload(["src.seller.watermarking"])
+    app.state.watermark_executor = concurrent.futures.ProcessPoolExecutor(max_workers=WATERMARK_PROCESS_WORKERS, mp_context=watermark_context)
+    await asyncio.to_thread(ensure_watermark_cache_expiration, get_s3_client(), get_bucket_name())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.audit_queue.put_nowait(AUDIT_LOG_STOP)
+    await app.state.audit_flusher
+    app.state.watermark_executor.shutdown(wait=False, cancel_futures=True)
+    rows = []
+    while not app.state.audit_queue.empty():
+        rows.append(app.state.audit_queue.get_nowait())
+    if rows:
+        await asyncio.to_thread(write_audit_logs, rows)
+
+def ndjson_line(obj) -> bytes:
+    return orjson.dumps(obj) + b"\n"
+
+async def stream_lines(lines):
+    for line in lines:
+        yield line
+
+def write_audit_logs(rows: list):
+    db = SessionLocal()
+    try:
+        db.execute(insert(AuditLog), rows)
+        db.commit()
+    except Exception as e:
+        print(f"Warning: Failed to log {len(rows)} queries: {e}")
+    finally:
+        db.close()
+
+async def flush_audit_logs(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await queue.get()
+        if row is AUDIT_LOG_STOP:
+            return
+        rows = [row]
+        deadline = loop.time() + AUDIT_LOG_FLUSH_INTERVAL_SECONDS
+        while len(rows) < AUDIT_LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is AUDIT_LOG_STOP:
+                stopping = True
+                break
+            rows.append(row)
+        await asyncio.to_thread(write_audit_logs, rows)
+
 @app.get("/shares")
 async def list_shares(
     maxResults: Optional[int] = None,
     pageToken: Optional[str] = None,
-    authorization: str = Header(None),
-    db: Session = Depends(get_db)
+    authorization: str = Header(None)
 ):
     token = extract_token_from_header(authorization)
-    share = get_share_from_token(token, db)
+    share = await asyncio.to_thread(get_cached_share_from_token, token)
     
     return {
         "items": [{"name": f"share_{share.id}"}],
@@ -60,11 +162,10 @@ async def list_schemas(
     share_name: str,
     maxResults: Optional[int] = None,
     pageToken: Optional[str] = None,
-    authorization: str = Header(None),
-    db: Session = Depends(get_db)
+    authorization: str = Header(None)
 ):
     token = extract_token_from_header(authorization)
-    share = get_share_from_token(token, db)
+    share = await asyncio.to_thread(get_cached_share_from_token, token)
     validate_share_access(share_name, share)
     
     return {
@@ -82,9 +183,7 @@ async def list_tables(
     db: Session = Depends(get_db)
 ):
     token = extract_token_from_header(authorization)
-    share = get_share_from_token(token, db)
-    validate_share_access(share_name, share)
-    dataset = get_dataset(share, db)
+    share, dataset = await asyncio.to_thread(load_share_and_dataset, token, share_name, db)
     
     table_name = dataset.table_name if dataset.table_name else dataset.name
     
@@ -102,9 +201,7 @@ async def get_table_metadata(
     db: Session = Depends(get_db)
 ):
     token = extract_token_from_header(authorization)
-    share = get_share_from_token(token, db)
-    validate_share_access(share_name, share)
-    dataset = get_dataset(share, db)
+    share, dataset = await asyncio.to_thread(load_share_and_dataset, token, share_name, db)
     
     expected_table_name = dataset.table_name if dataset.table_name else dataset.name
     if table_name != expected_table_name:
@@ -114,28 +211,24 @@ async def get_table_metadata(
     table_path = get_table_path(dataset, bucket_name, share)
     
     try:
-        storage_options = get_delta_storage_options()
-        delta_table = DeltaTable(table_path, storage_options=storage_options)
-        
-        metadata = delta_table.metadata()
-        schema = delta_table.schema()
-        
-        protocol_json = json.dumps({"protocol": {"minReaderVersion": 1}})
-        metadata_json = json.dumps({
-            "metaData": {
-                "id": metadata.id if hasattr(metadata, 'id') else table_name,
-                "format": {"provider": "parquet"},
-                "schemaString": schema.to_json(),
-                "partitionColumns": metadata.partition_columns if hasattr(metadata, 'partition_columns') else []
-            }
-        })
-        
-        content = f"{protocol_json}\n{metadata_json}\n"
+        table_metadata = await asyncio.to_thread(load_table_metadata, table_path, get_delta_storage_options())
+        
+        lines = [
+            ndjson_line({"protocol": {"minReaderVersion": 1}}),
+            ndjson_line({
+                "metaData": {
+                    "id": table_metadata["id"] or table_name,
+                    "format": {"provider": "parquet"},
+                    "schemaString": table_metadata["schema_string"],
+                    "partitionColumns": table_metadata["partition_columns"]
+                }
+            })
+        ]
         
         return StreamingResponse(
-            io.BytesIO(content.encode()),
+            stream_lines(lines),
             media_type="application/x-ndjson",
-            headers={"delta-table-version": str(delta_table.version())}
+            headers={"delta-table-version": str(table_metadata["version"])}
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error reading Delta table: {str(e)}")
@@ -150,9 +243,7 @@ async def get_table_version(
     db: Session = Depends(get_db)
 ):
     token = extract_token_from_header(authorization)
-    share = get_share_from_token(token, db)
-    validate_share_access(share_name, share)
-    dataset = get_dataset(share, db)
+    share, dataset = await asyncio.to_thread(load_share_and_dataset, token, share_name, db)
     
     expected_table_name = dataset.table_name if dataset.table_name else dataset.name
     if table_name != expected_table_name:
@@ -162,13 +253,12 @@ async def get_table_version(
     table_path = get_table_path(dataset, bucket_name, share)
     
     try:
-        storage_options = get_delta_storage_options()
-        delta_table = DeltaTable(table_path, storage_options=storage_options)
+        table_metadata = await asyncio.to_thread(load_table_metadata, table_path, get_delta_storage_options())
         
         return StreamingResponse(
             io.BytesIO(b""),
             media_type="application/json",
-            headers={"delta-table-version": str(delta_table.version())}
+            headers={"delta-table-version": str(table_metadata["version"])}
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error reading Delta table version: {str(e)}")
@@ -182,15 +272,17 @@ async def query_table(
     authorization: str = Header(None),
     db: Session = Depends(get_db)
 ):
-    try:
-        body = await request.json() if request.headers.get("content-type") == "application/json" else {}
-    except:
-        body = {}
+    body = {}
+    if int(request.headers.get("content-length") or 0) > 0 and request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            body = {}
+        if not isinstance(body, dict):
+            body = {}
     
     token = extract_token_from_header(authorization)
-    share = get_share_from_token(token, db)
-    validate_share_access(share_name, share)
-    dataset = get_dataset(share, db)
+    share, dataset = await asyncio.to_thread(load_share_and_dataset, token, share_name, db)
     
     expected_table_name = dataset.table_name if dataset.table_name else dataset.name
     if table_name != expected_table_name:
@@ -202,7 +294,7 @@ async def query_table(
     table_prefix = dataset.table_path.rstrip('/')
     
     requested_columns = body.get("columns")
-    requested_limit = body.get("limit")
+    requested_limit = body.get("limit", body.get("limitHint"))
     
     effective_limit = None
     if share.is_trial and share.trial_row_limit:
@@ -219,9 +311,7 @@ async def query_table(
         s3_client = get_s3_client()
         bucket = bucket_name
         
-        endpoint_url = os.getenv('S3_ENDPOINT_URL', '')
-        endpoint_for_client = fix_endpoint_url_for_client(endpoint_url).rstrip('/')
-        is_localstack = 'localhost:4566' in endpoint_for_client or 'localstack:4566' in endpoint_for_client or '127.0.0.1:4566' in endpoint_for_client
+        endpoint_for_client, is_localstack = get_client_endpoint(os.getenv('S3_ENDPOINT_URL', ''))
 
         storage_options = get_delta_storage_options()
         
@@ -230,11 +320,12 @@ async def query_table(
             full_synthetic_path = get_full_s3_path(bucket_name, synthetic_path)
             
             try:
-                delta_table = DeltaTable(full_synthetic_path, storage_options=storage_options)
+                delta_table = await asyncio.to_thread(get_cached_delta_table, full_synthetic_path, storage_options)
                 table_path = full_synthetic_path
             except Exception:
                 from src.seller.synthetic_data import generate_synthetic_data
-                synthetic_df, _ = generate_synthetic_data(
+                synthetic_df, _ = await asyncio.to_thread(
+                    generate_synthetic_data,
                     original_table_path=dataset.table_path,
                     output_table_path=synthetic_path,
                     num_rows=share.trial_row_limit or 100,
@@ -244,26 +335,31 @@ async def query_table(
                 )
                 table_path = full_synthetic_path
                 try:
-                    delta_table = DeltaTable(table_path, storage_options=storage_options)
+                    delta_table = await asyncio.to_thread(DeltaTable, table_path, storage_options=storage_options)
                 except Exception:
                     synthetic_table = pa.Table.from_pandas(synthetic_df)
-                    write_deltalake(table_path, synthetic_table, storage_options=storage_options, mode='overwrite')
-                    delta_table = DeltaTable(table_path, storage_options=storage_options)
+                    await asyncio.to_thread(write_deltalake, table_path, synthetic_table, storage_options=storage_options, mode='overwrite')
+                    delta_table = await asyncio.to_thread(DeltaTable, table_path, storage_options=storage_options)
         else:
-            watermarked_prefix = f"{table_prefix}/_watermarked_{share.id}_"
-            cleanup_old_watermarked_files(s3_client, bucket, watermarked_prefix)
-            delta_table = DeltaTable(table_path, storage_options=storage_options)
+            delta_table = await asyncio.to_thread(get_cached_delta_table, table_path, storage_options)
         
-        arrow_dataset = delta_table.to_pyarrow_dataset()
+        try:
+            metadata = delta_table.metadata()
+            table_version = delta_table.version()
+        except Exception as e:
+            print(f"Warning: Could not get metadata from DeltaTable: {e}")
+            metadata = None
+            table_version = 0
+        
+        arrow_dataset, schema_name_set = await asyncio.to_thread(get_cached_arrow_dataset, table_path, table_version, delta_table)
         original_schema = arrow_dataset.schema
         
-        schema_col_names = [field.name for field in original_schema]
+        schema_col_names = original_schema.names
         
         if not dataset.anchor_columns:
             raise HTTPException(status_code=500, detail="Dataset anchor_columns not configured. Anchor columns must be set at dataset creation time.")
         
-        anchor_columns_list = [col.strip() for col in dataset.anchor_columns.split(',') if col.strip()]
-        anchor_columns_list = [col for col in anchor_columns_list if col in schema_col_names]
+        anchor_columns_list = [col for col in parse_anchor_columns(dataset.anchor_columns) if col in schema_name_set]
         if not anchor_columns_list:
             raise HTTPException(status_code=500, detail="Configured anchor columns not found in table schema")
         
@@ -276,194 +372,165 @@ async def query_table(
             elif isinstance(requested_columns, str):
                 requested_columns_set = set([col.strip() for col in requested_columns.split(',')])
         
-        columns_to_read = list(requested_columns_set) if requested_columns_set else schema_col_names.copy()
-        
-        for anchor_col in anchor_columns_list:
-            if anchor_col not in columns_to_read:
-                columns_to_read.append(anchor_col)
+        columns_to_read = set(requested_columns_set) if requested_columns_set else set(schema_col_names)
+        columns_to_read.update(anchor_columns_list)
+        columns_to_read = list(columns_to_read)
         
-        columns_to_read = list(set(columns_to_read))
-        
-        missing_columns = [col for col in columns_to_read if col not in schema_col_names]
+        missing_columns = sorted(set(columns_to_read) - schema_name_set)
         if missing_columns:
             raise HTTPException(status_code=400, detail=f"Columns not found: {', '.join(missing_columns)}")
         
-        missing_anchor_cols = [col for col in anchor_columns_list if col not in columns_to_read]
-        if missing_anchor_cols:
-            raise HTTPException(status_code=500, detail=f"Anchor columns missing from projection: {', '.join(missing_anchor_cols)}")
-        
         schema_fields_for_scan = [field for field in original_schema if field.name in columns_to_read]
         if not schema_fields_for_scan:
             raise HTTPException(status_code=500, detail=f"No valid columns to read. Requested: {columns_to_read}, Available: {schema_col_names}")
         
-        projected_schema_for_scan = pa.schema(schema_fields_for_scan)
-        
-        try:
-            scanner_kwargs = {}
-            if columns_to_read:
-                scanner_kwargs['columns'] = columns_to_read
-            if filter_expr is not None:
-                scanner_kwargs['filter'] = filter_expr
-            
-            scanner = arrow_dataset.scanner(**scanner_kwargs)
-        except HTTPException:
-            raise
-        except Exception as e:
-            error_msg = str(e) if str(e) else repr(e)
-            raise HTTPException(status_code=500, detail=f"Failed to create scanner: {error_msg}")
-        
-        record_batches = []
-        rows_scanned = 0
-        
-        for batch in scanner.to_batches():
-            if effective_limit and rows_scanned >= effective_limit:
-                break
-            
-            batch_size = len(batch)
-            if effective_limit:
-                remaining = effective_limit - rows_scanned
-                if remaining < batch_size:
-                    batch = batch.slice(0, remaining)
-            
-            record_batches.append(batch)
-            rows_scanned += len(batch)
-            
-            if effective_limit and rows_scanned >= effective_limit:
-                break
-        
-        if not record_batches:
-            result_table = pa.Table.from_arrays([[] for _ in projected_schema_for_scan], schema=projected_schema_for_scan)
+        direct_files = None
+        if not share.is_trial and filter_expr is None and not requested_columns_set and not effective_limit:
+            if share.watermarked_table_path or not await asyncio.to_thread(table_needs_watermarking, table_path, table_version, arrow_dataset):
+                direct_files = await asyncio.to_thread(list_table_files, delta_table)
+        
+        partition_values_map = {}
+        if direct_files is not None:
+            actual_rows_returned = sum(file_info["num_records"] for file_info in direct_files)
+            columns_returned = list(schema_col_names)
+            effective_anchor_columns = anchor_columns_list
+            files_list = []
+            size_map = {}
+            for file_info in direct_files:
+                file_path = file_info["path"] if "://" in file_info["path"] else f"{table_path.rstrip('/')}/{file_info['path']}"
+                key = file_path.removeprefix(f"s3://{bucket}/")
+                files_list.append(key)
+                size_map[key] = file_info["size"]
+                partition_values_map[key] = file_info["partition_values"]
         else:
-            result_table = pa.Table.from_batches(record_batches)
-        
-        if len(result_table.schema) == 0:
-            raise HTTPException(status_code=500, detail="Query returned table with empty schema. This may indicate a column projection issue.")
-        
-        df = result_table.to_pandas()
-        
-        if df.empty and len(df.columns) == 0 and len(record_batches) > 0:
-            first_batch = record_batches[0]
-            if len(first_batch.schema) > 0:
-                df = first_batch.to_pandas()
-        
-        if len(df.columns) == 0:
-            raise HTTPException(status_code=500, detail=f"Query returned DataFrame with no columns. Schema had {len(result_table.schema)} fields, record_batches: {len(record_batches)}")
-        
-        available_anchor_cols = [col for col in anchor_columns_list if col in df.columns]
-        if len(available_anchor_cols) != len(anchor_columns_list):
-            missing = [col for col in anchor_columns_list if col not in df.columns]
-            print(f"Warning: Anchor columns missing from query result: {missing}. Available: {available_anchor_cols}")
-        
-        effective_anchor_columns = available_anchor_cols if available_anchor_cols else None
-        
-        watermarked_df = apply_watermark_to_dataframe(df, watermark, is_trial=share.is_trial, anchor_columns=effective_anchor_columns)
-        
-        if requested_columns_set:
-            columns_to_return = list(requested_columns_set)
-            
-            for anchor_col in effective_anchor_columns or []:
-                if anchor_col not in requested_columns_set and anchor_col in columns_to_return:
-                    columns_to_return.remove(anchor_col)
-            
-            if '_watermark_id' in watermarked_df.columns and share.is_trial:
-                if '_watermark_id' not in requested_columns_set and '_watermark_id' in columns_to_return:
-                    columns_to_return.remove('_watermark_id')
-            
-            if columns_to_return:
-                available_cols = [col for col in columns_to_return if col in watermarked_df.columns]
-                if available_cols:
-                    watermarked_df = watermarked_df[available_cols]
-                else:
-                    raise HTTPException(status_code=400, detail="None of the requested columns are available in the result")
-        
-        actual_rows_returned = len(watermarked_df)
-        columns_returned = list(watermarked_df.columns)
-        
-        temp_key = f"{table_prefix}/_watermarked_{share.id}_{uuid.uuid4().hex[:8]}.parquet"
-        
-        watermarked_table = pa.Table.from_pandas(watermarked_df, preserve_index=False)
-        projected_schema = watermarked_table.schema
-        
-        tmp_path = None
-        try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.parquet') as tmp_file:
-                tmp_path = tmp_file.name
-            
-            pq.write_table(watermarked_table, tmp_path)
-            
-            extra_args = {}
-            if is_localstack:
-                extra_args['ContentType'] = 'application/octet-stream'
-            
-            s3_client.upload_file(tmp_path, bucket, temp_key, ExtraArgs=extra_args)
+            temp_key = get_watermark_cache_key(
+                table_prefix, share.id, table_version, watermark,
+                requested_columns_set, body, effective_limit
+            )
             
-            max_retries = 3
-            for i in range(max_retries):
-                try:
-                    s3_client.head_object(Bucket=bucket, Key=temp_key)
-                    break
-                except Exception as e:
-                    if i < max_retries - 1:
-                        time.sleep(0.2)
+            query_lock_entry = QUERY_RESULT_LOCKS.setdefault(temp_key, [asyncio.Lock(), 0])
+            query_lock_entry[1] += 1
+            try:
+                async with query_lock_entry[0]:
+                    cached_result = get_cached_query_result(temp_key)
+                    if cached_result is None:
+                        cached_object = await asyncio.to_thread(head_cached_object, s3_client, bucket, temp_key)
+                        if cached_object:
+                            cached_result = (
+                                int(cached_object['Metadata'].get('rows', 0)),
+                                await asyncio.to_thread(read_cached_parquet_columns, s3_client, bucket, temp_key, cached_object['ContentLength']),
+                                cached_object['ContentLength']
+                            )
+                    
+                    if cached_result:
+                        actual_rows_returned, columns_returned, file_size = cached_result
+                        effective_anchor_columns = anchor_columns_list
                     else:
-                        raise Exception(f"File not accessible after upload: {e}")
-        finally:
-            if tmp_path and os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-        
-        files_list = [get_full_s3_path(bucket, temp_key)]
-        
-        try:
-            metadata = delta_table.metadata()
-            table_version = delta_table.version()
-        except Exception as e:
-            print(f"Warning: Could not get metadata from DeltaTable: {e}")
-            metadata = None
-            table_version = 0
+                        try:
+                            scanner_kwargs = {
+                                'batch_size': SCAN_BATCH_SIZE,
+                                'fragment_readahead': SCAN_FRAGMENT_READAHEAD,
+                                'use_threads': True
+                            }
+                            if columns_to_read:
+                                scanner_kwargs['columns'] = columns_to_read
+                            if filter_expr is not None:
+                                scanner_kwargs['filter'] = filter_expr
+                            
+                            scanner = arrow_dataset.scanner(**scanner_kwargs)
+                        except HTTPException:
+                            raise
+                        except Exception as e:
+                            error_msg = str(e) if str(e) else repr(e)
+                            raise HTTPException(status_code=500, detail=f"Failed to create scanner: {error_msg}")
+                        
+                        if effective_limit:
+                            result_table = await asyncio.to_thread(scanner.head, effective_limit)
+                        else:
+                            result_table = await asyncio.to_thread(scanner.to_table)
+                        
+                        if len(result_table.schema) == 0:
+                            raise HTTPException(status_code=500, detail="Query returned table with empty schema. This may indicate a column projection issue.")
+                        
+                        available_anchor_cols = [col for col in anchor_columns_list if col in result_table.column_names]
+                        if len(available_anchor_cols) != len(anchor_columns_list):
+                            missing = [col for col in anchor_columns_list if col not in result_table.column_names]
+                            print(f"Warning: Anchor columns missing from query result: {missing}. Available: {available_anchor_cols}")
+                        
+                        effective_anchor_columns = available_anchor_cols if available_anchor_cols else None
+                        
+                        if result_table.num_rows == 0:
+                            actual_rows_returned = 0
+                            columns_returned = [col for col in result_table.column_names if not requested_columns_set or col in requested_columns_set]
+                            file_size = None
+                        else:
+                            columns_to_return = list(requested_columns_set) if requested_columns_set else None
+                            parquet_options = {
+                                'compression': WATERMARK_PARQUET_COMPRESSION,
+                                'compression_level': WATERMARK_PARQUET_COMPRESSION_LEVEL,
+                                'use_dictionary': True,
+                                'write_statistics': True,
+                                'data_page_size': WATERMARK_PARQUET_DATA_PAGE_SIZE,
+                                'max_row_group_size': WATERMARK_PARQUET_MAX_ROW_GROUP_SIZE
+                            }
+                            
+                            ipc_bytes = await asyncio.to_thread(serialize_arrow_table, result_table)
+                            parquet_bytes, actual_rows_returned, columns_returned = await asyncio.get_running_loop().run_in_executor(
+                                getattr(request.app.state, 'watermark_executor', None),
+                                encode_watermarked_parquet,
+                                ipc_bytes,
+                                watermark,
+                                share.is_trial,
+                                effective_anchor_columns,
+                                columns_to_return,
+                                parquet_options
+                            )
+                            if not columns_returned:
+                                raise HTTPException(status_code=400, detail="None of the requested columns are available in the result")
+                            
+                            await asyncio.to_thread(
+                                s3_client.upload_fileobj,
+                                io.BytesIO(parquet_bytes),
+                                bucket,
+                                temp_key,
+                                ExtraArgs={
+                                    'ContentType': 'application/octet-stream' if is_localstack else 'application/x-parquet',
+                                    'Tagging': WATERMARK_CACHE_TAG,
+                                    'Metadata': {'rows': str(actual_rows_returned)}
+                                },
+                                Config=UPLOAD_TRANSFER_CONFIG
+                            )
+                            file_size = len(parquet_bytes)
+                    
+                    if len(QUERY_RESULT_CACHE) >= QUERY_RESULT_CACHE_MAX_SIZE:
+                        QUERY_RESULT_CACHE.clear()
+                    QUERY_RESULT_CACHE[temp_key] = (time.monotonic() + QUERY_RESULT_CACHE_TTL_SECONDS, actual_rows_returned, columns_returned, file_size)
+            finally:
+                query_lock_entry[1] -= 1
+                if query_lock_entry[1] == 0:
+                    QUERY_RESULT_LOCKS.pop(temp_key, None)
+            
+            if file_size is None:
+                size_map = {}
+                files_list = []
+            else:
+                size_map = {temp_key: file_size}
+                files_list = [temp_key]
         
         try:
-            if len(watermarked_df.columns) == 0:
-                raise ValueError(f"Cannot generate schema: watermarked_df has no columns. Original df had {len(df.columns)} columns: {list(df.columns)}")
-            
-            final_columns = list(watermarked_df.columns)
-            
-            delta_schema = delta_table.schema()
-            full_schema_json_str = delta_schema.to_json()
-            full_schema_obj = json.loads(full_schema_json_str)
-            
-            if 'fields' not in full_schema_obj:
-                raise ValueError(f"Delta schema JSON missing 'fields' key: {full_schema_obj}")
-            
-            original_field_names = {field.get('name') for field in full_schema_obj.get('fields', [])}
-            
-            columns_in_original_schema = [col for col in final_columns if col in original_field_names]
-            
-            if not columns_in_original_schema:
-                raise ValueError(f"No columns from watermarked_df found in original schema. watermarked_df columns: {list(watermarked_df.columns)}, original schema fields: {list(original_field_names)}")
+            if not columns_returned:
+                raise ValueError("Cannot generate schema: watermarked table has no columns")
             
-            filtered_fields = [field for field in full_schema_obj['fields'] if field.get('name') in columns_in_original_schema]
-            
-            if not filtered_fields:
-                raise ValueError(f"No matching schema fields found. columns_in_original_schema: {columns_in_original_schema}, available fields: {[f.get('name') for f in full_schema_obj.get('fields', [])]}")
-            
-            schema_obj = {
-                "type": "struct",
-                "fields": filtered_fields
-            }
-            
-            schema_obj = transform_schema_for_timestamp_ntz(schema_obj)
-            schema_string = json.dumps(schema_obj)
-            
-            if schema_string == '{"type":"struct","fields":[]}':
-                raise ValueError(f"Generated empty schema. watermarked_df columns: {list(watermarked_df.columns)}")
+            table_metadata = await asyncio.to_thread(load_table_metadata, table_path, storage_options)
+            schema_string = build_shared_schema_string(table_metadata["shared_schema_fields"], columns_returned)
         except Exception as e:
-            error_msg = f"Failed to generate schema: {str(e)}. watermarked_df shape: {watermarked_df.shape}, columns: {list(watermarked_df.columns)}"
+            error_msg = f"Failed to generate schema: {str(e)}. watermarked table rows: {actual_rows_returned}, columns: {columns_returned}"
             print(f"ERROR: {error_msg}")
             raise HTTPException(status_code=500, detail=error_msg)
         
         lines = []
         
-        lines.append(json.dumps({"protocol": {"minReaderVersion": 1}}))
+        lines.append(ndjson_line({"protocol": {"minReaderVersion": 1}}))
         
         if schema_string is None:
             schema_string = '{"type":"struct","fields":[]}'
@@ -471,7 +538,7 @@ async def query_table(
         metadata_id = metadata.id if metadata and hasattr(metadata, 'id') else table_name
         partition_columns = metadata.partition_columns if metadata and hasattr(metadata, 'partition_columns') else []
         
-        lines.append(json.dumps({
+        lines.append(ndjson_line({
             "metaData": {
                 "id": metadata_id,
                 "format": {"provider": "parquet"},
@@ -480,37 +547,21 @@ async def query_table(
             }
         }))
         
-        for file_path in files_list:
-            if file_path.startswith(f"s3://{bucket}/"):
-                key = file_path.replace(f"s3://{bucket}/", "")
-            elif file_path.startswith("/"):
-                key = file_path.lstrip("/")
-            else:
-                key = file_path
-            
-            if not key.startswith(table_prefix) and table_prefix:
-                key = f"{table_prefix}/{key}" if not key.startswith("/") else f"{table_prefix}{key}"
-            
+        for key in files_list:
             presigned_url = get_presigned_url(s3_client, bucket, key, endpoint_for_client, is_localstack)
             
-            try:
-                response = s3_client.head_object(Bucket=bucket, Key=key)
-                file_size = response.get('ContentLength', 0)
-            except:
-                file_size = 0
+            file_size = size_map.get(key, 0)
             
             file_action = {
                 "file": {
                     "url": presigned_url,
                     "id": key,
-                    "partitionValues": {},
+                    "partitionValues": partition_values_map.get(key, {}),
                     "size": file_size,
                     "version": table_version
                 }
             }
-            lines.append(json.dumps(file_action))
-        
-        content = "\n".join(lines) + "\n"
+            lines.append(ndjson_line(file_action))
         
         try:
             columns_requested = None
@@ -546,9 +597,9 @@ async def query_table(
             }
             client_metadata = json.dumps(client_metadata_dict) if any(client_metadata_dict.values()) else None
             
-            bytes_served = len(content.encode('utf-8'))
+            bytes_served = sum(len(line) for line in lines)
             
-            audit_log = AuditLog(
+            request.app.state.audit_queue.put_nowait(dict(
                 buyer_id=share.buyer_id,
                 dataset_id=share.dataset_id,
                 share_id=share.id,
@@ -562,15 +613,14 @@ async def query_table(
                 anchor_columns_used=','.join(effective_anchor_columns) if effective_anchor_columns else '',
                 ip_address=client_ip,
                 bytes_served=bytes_served,
-                client_metadata=client_metadata
-            )
-            db.add(audit_log)
-            db.commit()
+                client_metadata=client_metadata,
+                query_time=datetime.utcnow()
+            ))
         except Exception as e:
             print(f"Warning: Failed to log query: {e}")
         
         return StreamingResponse(
-            io.BytesIO(content.encode()),
+            stream_lines(lines),
             media_type="application/x-ndjson",
             headers={"delta-table-version": str(table_version)}
         )
@@ -598,7 +648,7 @@ async def publish_metadata(
     try:
         from jose import jwt
         settings = get_settings()
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        payload = jwt.decode(token, settings.get_jwt_verification_key(), algorithms=[settings.JWT_ALGORITHM])
         user_id = int(payload.get("sub"))
         user = db.query(User).filter(User.id == user_id).first()
         if not user or user.role != "seller":
@@ -611,7 +661,8 @@ async def publish_metadata(
         anchor_cols_list = [col.strip() for col in request_data.anchor_columns.split(',') if col.strip()]
     
     try:
-        metadata = publish_dataset_metadata(
+        metadata = await asyncio.to_thread(
+            publish_dataset_metadata,
             table_path=request_data.table_path,
             seller_id=user.id,
             name=request_data.name,
@@ -636,7 +687,7 @@ async def generate_synthetic_dataset(
     try:
         from jose import jwt
         settings = get_settings()
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        payload = jwt.decode(token, settings.get_jwt_verification_key(), algorithms=[settings.JWT_ALGORITHM])
         user_id = int(payload.get("sub"))
         user = db.query(User).filter(User.id == user_id).first()
         if not user or user.role != "seller":
@@ -678,7 +729,7 @@ async def generate_file_download(
     try:
         from jose import jwt
         settings = get_settings()
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        payload = jwt.decode(token, settings.get_jwt_verification_key(), algorithms=[settings.JWT_ALGORITHM])
         user_id = int(payload.get("sub"))
         user = db.query(User).filter(User.id == user_id).first()
         if not user or user.role != "seller":
@@ -712,31 +763,28 @@ async def generate_file_download(
         
         original_table_path = get_full_s3_path(bucket_name, dataset.table_path)
         
-        delta_table = DeltaTable(original_table_path, storage_options=storage_options)
-        df = delta_table.to_pandas()
+        delta_table = await asyncio.to_thread(DeltaTable, original_table_path, storage_options=storage_options)
+        table = await asyncio.to_thread(delta_table.to_pyarrow_table)
         
         snapshot_id = f"snapshot_{share_id}_{int(datetime.utcnow().timestamp())}"
         snapshot_key = f"snapshots/{snapshot_id}.parquet"
         snapshot_path = get_full_s3_path(bucket_name, snapshot_key)
         
-        table = pa.Table.from_pandas(df)
-        
-        with tempfile.NamedTemporaryFile(suffix='.parquet', delete=False) as tmp_file:
-            pq.write_table(table, tmp_file.name)
-            tmp_file_path = tmp_file.name
-            file_size = os.path.getsize(tmp_file_path)
-        
-        try:
-            s3_client.upload_file(tmp_file_path, bucket_name, snapshot_key)
-        finally:
-            if os.path.exists(tmp_file_path):
-                os.unlink(tmp_file_path)
+        sink = pa.BufferOutputStream()
+        await asyncio.to_thread(pq.write_table, table, sink)
+        body_buffer = sink.getvalue()
+        file_size = body_buffer.size
+        await asyncio.to_thread(
+            s3_client.upload_fileobj,
+            io.BytesIO(memoryview(body_buffer)),
+            bucket_name,
+            snapshot_key,
+            Config=UPLOAD_TRANSFER_CONFIG
+        )
         
         expires_at = datetime.utcnow() + timedelta(hours=request.expiry_hours)
         
-        endpoint_url = os.getenv('S3_ENDPOINT_URL', 'http://localhost:4566')
-        endpoint_for_client = fix_endpoint_url_for_client(endpoint_url).rstrip('/')
-        is_localstack = 'localhost:4566' in endpoint_for_client or 'localstack:4566' in endpoint_for_client or '127.0.0.1:4566' in endpoint_for_client
+        endpoint_for_client, is_localstack = get_client_endpoint(os.getenv('S3_ENDPOINT_URL', 'http://localhost:4566'))
         
         presigned_url = get_presigned_url(s3_client, bucket_name, snapshot_key, endpoint_for_client, is_localstack)
         
@@ -747,7 +795,7 @@ async def generate_file_download(
             buyer_id=share.buyer_id,
             dataset_id=dataset.id,
             share_id=share.id,
-            row_count_returned=len(df),
+            row_count_returned=table.num_rows,
             bytes_served=file_size,
             client_metadata=json.dumps({"delivery_method": "file_link", "download_token": download_token, "snapshot_id": snapshot_id, "expiry_hours": request.expiry_hours})
         )
@@ -760,8 +808,8 @@ async def generate_file_download(
             expires_at=expires_at.isoformat(),
             snapshot_id=snapshot_id,
             file_size_bytes=file_size,
-            rows=len(df),
-            columns=list(df.columns)
+            rows=table.num_rows,
+            columns=table.column_names
         )
     except Exception as e:
         raise HTTPException(
@@ -780,7 +828,7 @@ async def encrypt_share_token(
     try:
         from jose import jwt
         settings = get_settings()
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        payload = jwt.decode(token, settings.get_jwt_verification_key(), algorithms=[settings.JWT_ALGORITHM])
         user_id = int(payload.get("sub"))
         user = db.query(User).filter(User.id == user_id).first()
         if not user or user.role != "seller":
@@ -826,7 +874,7 @@ async def revoke_file_download(
     try:
         from jose import jwt
         settings = get_settings()
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        payload = jwt.decode(token, settings.get_jwt_verification_key(), algorithms=[settings.JWT_ALGORITHM])
         user_id = int(payload.get("sub"))
         user = db.query(User).filter(User.id == user_id).first()
         if not user or user.role != "seller":
@@ -839,7 +887,7 @@ async def revoke_file_download(
         bucket_name = get_bucket_name()
         snapshot_key = f"snapshots/{snapshot_id}.parquet"
         
-        s3_client.delete_object(Bucket=bucket_name, Key=snapshot_key)
+        await asyncio.to_thread(s3_client.delete_object, Bucket=bucket_name, Key=snapshot_key)
         
         return {"status": "success", "message": f"File download {snapshot_id} revoked"}
     except Exception as e:
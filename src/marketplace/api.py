@@ -1,20 +1,25 @@
 from fastapi import FastAPI, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import or_
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import or_, and_, func, exists, tuple_
+from sqlalchemy.exc import IntegrityError
 from typing import Optional
 from datetime import datetime, timedelta
+import anyio
 import secrets
+import threading
 import hashlib
-import json
+import orjson
 import requests
 import os
 import traceback
 from src.models.database import (
-    init_db, User, Dataset, Share, Purchase, AuditLog, get_db
+    init_db, User, Dataset, Share, Purchase, AuditLog, get_db,
+    DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW
 )
 from src.marketplace.auth import (
-    get_password_hash, verify_password, create_access_token,
-    get_current_user, get_current_seller, get_current_buyer
+    get_password_hash, verify_and_update_password, create_access_token,
+    get_current_user, get_current_seller, get_current_buyer, invalidate_cached_user, DUMMY_PASSWORD_HASH
 )
 from src.marketplace.schemas import (
     UserRegister, UserLogin, Token, UserResponse,
@@ -30,10 +35,43 @@ from src.utils.settings import get_settings
 from src.utils.encryption import validate_public_key
 from src.seller.profile_generator import generate_delta_sharing_profile, generate_profile_json
 
-app = FastAPI(title="Delta Sharing Marketplace API")
+app = FastAPI(title="Delta Sharing Marketplace API", default_response_class=ORJSONResponse)
+
+settings = get_settings()
+
+MY_SHARES_PAGE_SIZE = 1000
+DATASET_RESPONSE_COLUMNS = (
+    Dataset.id, Dataset.name, Dataset.description, Dataset.table_path, Dataset.price,
+    Dataset.is_public, Dataset.seller_id, Dataset.created_at, Dataset.risk_score, Dataset.risk_level
+)
+USAGE_LOGS_PAGE_SIZE = 100
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+API_THREADPOOL_SIZE = int(os.getenv(
+    "API_THREADPOOL_SIZE",
+    str(min(DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW, (os.cpu_count() or 1) * 32))
+))
+
+SELLER_HTTP_SESSION = requests.Session()
+SELLER_HTTP_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=API_THREADPOOL_SIZE))
+SELLER_HTTP_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=API_THREADPOOL_SIZE))
+
+PROFILE_GENERATION_LOCKS = tuple(threading.Lock() for _ in range(64))
+
+def raise_share_not_updated(db: Session, share_id: int, forbidden_detail: str):
+    if db.query(exists().where(Share.id == share_id)).scalar():
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=forbidden_detail
+        )
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="Share not found"
+    )
 
 @app.on_event("startup")
 async def startup_event():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = API_THREADPOOL_SIZE
     init_db()
 
 @app.get("/health")
@@ -41,9 +79,8 @@ async def health():
     return {"status": "healthy"}
 
 @app.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def register(user_data: UserRegister, db: Session = Depends(get_db)):
-    existing_user = db.query(User).filter(User.email == user_data.email).first()
-    if existing_user:
+def register(user_data: UserRegister, db: Session = Depends(get_db)):
+    if db.query(exists().where(User.email == user_data.email)).scalar():
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
@@ -63,19 +100,23 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
     )
     db.add(user)
     db.commit()
-    db.refresh(user)
     return user
 
 @app.post("/login", response_model=Token)
-async def login(credentials: UserLogin, db: Session = Depends(get_db)):
+def login(credentials: UserLogin, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.email == credentials.email).first()
-    if not user or not verify_password(credentials.password, user.hashed_password):
+    password_valid, new_hash = verify_and_update_password(credentials.password, user.hashed_password if user else DUMMY_PASSWORD_HASH)
+    if not user or not password_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    if new_hash:
+        user.hashed_password = new_hash
+        db.commit()
+    
     access_token_expires = timedelta(minutes=30)
     access_token = create_access_token(
         data={"sub": str(user.id)}, expires_delta=access_token_expires
@@ -83,22 +124,25 @@ async def login(credentials: UserLogin, db: Session = Depends(get_db)):
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/me", response_model=UserResponse)
-async def get_me(current_user: User = Depends(get_current_user)):
+def get_me(current_user: User = Depends(get_current_user)):
     return current_user
 
 @app.put("/me/delta-sharing-server-url")
-async def update_delta_sharing_server_url(
+def update_delta_sharing_server_url(
     request: DeltaSharingServerUrlRequest,
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
 ):
-    current_user.delta_sharing_server_url = request.server_url
+    db.query(User).filter(User.id == current_user.id).update(
+        {User.delta_sharing_server_url: request.server_url},
+        synchronize_session=False
+    )
     db.commit()
-    db.refresh(current_user)
-    return {"delta_sharing_server_url": current_user.delta_sharing_server_url}
+    invalidate_cached_user(current_user.id)
+    return {"delta_sharing_server_url": request.server_url}
 
 @app.put("/me/public-key", response_model=PublicKeyRegistrationResponse)
-async def register_public_key(
+def register_public_key(
     request: PublicKeyRegistrationRequest,
     current_user: User = Depends(get_current_buyer),
     db: Session = Depends(get_db)
@@ -109,8 +153,12 @@ async def register_public_key(
             detail="Invalid public key format"
         )
     
-    current_user.public_key = request.public_key
+    db.query(User).filter(User.id == current_user.id).update(
+        {User.public_key: request.public_key},
+        synchronize_session=False
+    )
     db.commit()
+    invalidate_cached_user(current_user.id)
     
     return PublicKeyRegistrationResponse(
         status="success",
@@ -118,7 +166,7 @@ async def register_public_key(
     )
 
 @app.get("/shares/{share_id}/buyer-public-key")
-async def get_buyer_public_key(
+def get_buyer_public_key(
     share_id: int,
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
@@ -146,18 +194,19 @@ async def get_buyer_public_key(
     return {"public_key": buyer.public_key}
 
 @app.get("/datasets", response_model=list[DatasetResponse])
-async def list_datasets(
+def list_datasets(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    query = db.query(*DATASET_RESPONSE_COLUMNS)
     if current_user.role == "seller":
-        datasets = db.query(Dataset).filter(Dataset.seller_id == current_user.id).all()
+        rows = query.filter(Dataset.seller_id == current_user.id).all()
     else:
-        datasets = db.query(Dataset).filter(Dataset.is_public == True).all()
-    return datasets
+        rows = query.filter(Dataset.is_public == True).all()
+    return ORJSONResponse([row._asdict() for row in rows])
 
 @app.post("/datasets", response_model=DatasetResponse, status_code=status.HTTP_201_CREATED)
-async def create_dataset(
+def create_dataset(
     dataset_data: DatasetCreate,
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
@@ -180,26 +229,19 @@ async def create_dataset(
         anchor_columns = ','.join(metadata.get("anchor_columns", []))
         pii_analysis = metadata.get("pii_analysis", {})
         risk_score = pii_analysis.get("risk_score", 0.0)
-        risk_level = pii_analysis.get("risk_level", "low")
-        sensitive_columns = json.dumps(pii_analysis.get("sensitive_columns", {}))
-        detected_pii_types = ','.join(pii_analysis.get("pii_types", {}).keys())
         
-        dataset = Dataset(
+        dataset_fields = dict(
             name=metadata.get("name") or dataset_data.name,
             description=metadata.get("description") or dataset_data.description,
             table_path=metadata.get("table_path") or dataset_data.table_path,
-            price=dataset_data.price,
-            is_public=dataset_data.is_public,
-            seller_id=current_user.id,
-            anchor_columns=anchor_columns,
             risk_score=risk_score,
-            risk_level=risk_level,
-            sensitive_columns=sensitive_columns,
-            detected_pii_types=detected_pii_types,
+            risk_level=pii_analysis.get("risk_level", "low"),
+            sensitive_columns=orjson.dumps(pii_analysis.get("sensitive_columns", {})).decode(),
+            detected_pii_types=','.join(pii_analysis.get("pii_types", {}).keys()),
             requires_approval=risk_score >= 20.0
         )
     else:
-        anchor_columns = dataset_data.anchor_columns if dataset_data.anchor_columns and dataset_data.anchor_columns.strip() else None
+        anchor_columns = dataset_data.anchor_columns.strip() if dataset_data.anchor_columns else None
         
         if not anchor_columns:
             raise HTTPException(
@@ -207,34 +249,41 @@ async def create_dataset(
                 detail="metadata_bundle is required. Please provide a signed metadata bundle from the seller publish endpoint."
             )
         
-        dataset = Dataset(
+        dataset_fields = dict(
             name=dataset_data.name,
             description=dataset_data.description,
-            table_path=dataset_data.table_path,
-            price=dataset_data.price,
-            is_public=dataset_data.is_public,
-            seller_id=current_user.id,
-            anchor_columns=anchor_columns
+            table_path=dataset_data.table_path
         )
     
+    dataset = Dataset(
+        price=dataset_data.price,
+        is_public=dataset_data.is_public,
+        seller_id=current_user.id,
+        anchor_columns=anchor_columns,
+        **dataset_fields
+    )
+    
     db.add(dataset)
     db.commit()
-    db.refresh(dataset)
     return dataset
 
 @app.post("/purchase/{dataset_id}", response_model=PurchaseResponse)
-async def purchase_dataset(
+def purchase_dataset(
     dataset_id: int,
     current_user: User = Depends(get_current_buyer),
     db: Session = Depends(get_db)
 ):
     try:
-        dataset = db.query(Dataset).filter(Dataset.id == dataset_id).first()
-        if not dataset:
+        row = db.query(Dataset, Share).options(joinedload(Dataset.seller)).outerjoin(
+            Share,
+            and_(Share.dataset_id == Dataset.id, Share.buyer_id == current_user.id)
+        ).filter(Dataset.id == dataset_id).first()
+        if not row:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Dataset not found"
             )
+        dataset, existing_share = row
         
         if not dataset.is_public and dataset.seller_id != current_user.id:
             raise HTTPException(
@@ -242,21 +291,16 @@ async def purchase_dataset(
                 detail="Dataset is not public and you are not the seller"
             )
         
-        existing_share = db.query(Share).filter(
-            Share.dataset_id == dataset_id,
-            Share.buyer_id == current_user.id
-        ).first()
-        
         if existing_share:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="You already have access to this dataset"
             )
         
-        settings = get_settings()
         expires_at = datetime.utcnow() + timedelta(days=settings.TOKEN_EXPIRY_DAYS)
         
         approval_status = "pending" if dataset.requires_approval else "approved"
+        seller_server_url = dataset.seller.delta_sharing_server_url if dataset.seller else None
         
         share = Share(
             dataset_id=dataset_id,
@@ -269,9 +313,14 @@ async def purchase_dataset(
             approval_status=approval_status
         )
         db.add(share)
-        db.commit()
-        db.refresh(share)
-        
+        try:
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="You already have access to this dataset"
+            )
         
         purchase = Purchase(
             buyer_id=current_user.id,
@@ -281,12 +330,6 @@ async def purchase_dataset(
         )
         db.add(purchase)
         db.commit()
-        db.refresh(purchase)
-        
-        approval_status_value = getattr(share, 'approval_status', None) or approval_status
-        
-        seller = db.query(User).filter(User.id == dataset.seller_id).first()
-        seller_server_url = seller.delta_sharing_server_url if seller else None
         
         response_data = {
             "id": purchase.id,
@@ -296,11 +339,11 @@ async def purchase_dataset(
             "amount": purchase.amount,
             "created_at": purchase.created_at,
             "share_token": None,
-            "approval_status": approval_status_value,
+            "approval_status": approval_status,
             "seller_server_url": seller_server_url
         }
         
-        return PurchaseResponse(**response_data)
+        return ORJSONResponse(response_data)
     except HTTPException:
         raise
     except Exception as e:
@@ -312,18 +355,29 @@ async def purchase_dataset(
         )
 
 @app.post("/datasets/{dataset_id}/trial", response_model=TrialResponse)
-async def request_trial(
+def request_trial(
     dataset_id: int,
     trial_request: TrialRequest,
     current_user: User = Depends(get_current_buyer),
     db: Session = Depends(get_db)
 ):
-    dataset = db.query(Dataset).filter(Dataset.id == dataset_id).first()
-    if not dataset:
+    now = datetime.utcnow()
+    row = db.query(Dataset, Share).options(joinedload(Dataset.seller)).outerjoin(
+        Share,
+        and_(
+            Share.dataset_id == Dataset.id,
+            Share.buyer_id == current_user.id,
+            Share.is_trial == True,
+            Share.revoked == False,
+            Share.trial_expires_at > now
+        )
+    ).filter(Dataset.id == dataset_id).first()
+    if not row:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Dataset not found"
         )
+    dataset, existing_trial = row
     
     if not dataset.is_public and dataset.seller_id != current_user.id:
         raise HTTPException(
@@ -331,19 +385,11 @@ async def request_trial(
             detail="Dataset is not public and you are not the seller"
         )
     
-    existing_trial = db.query(Share).filter(
-        Share.dataset_id == dataset_id,
-        Share.buyer_id == current_user.id,
-        Share.is_trial == True,
-        Share.revoked == False
-    ).first()
-    
     if existing_trial:
-        if existing_trial.trial_expires_at and existing_trial.trial_expires_at > datetime.utcnow():
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="You already have an active trial for this dataset"
-            )
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You already have an active trial for this dataset"
+        )
     
     if not current_user.public_key:
         raise HTTPException(
@@ -352,7 +398,9 @@ async def request_trial(
         )
     
     row_limit = min(trial_request.row_limit or 100, 1000)
-    expires_at = datetime.utcnow() + timedelta(days=trial_request.days_valid or 7)
+    expires_at = now + timedelta(days=trial_request.days_valid or 7)
+    seller = dataset.seller
+    seller_server_url = seller.delta_sharing_server_url if seller else None
     
     share = Share(
         dataset_id=dataset_id,
@@ -369,19 +417,17 @@ async def request_trial(
     )
     db.add(share)
     db.commit()
-    db.refresh(share)
     
-    seller = db.query(User).filter(User.id == dataset.seller_id).first()
-    if seller and seller.delta_sharing_server_url:
+    if seller_server_url:
         try:
             seller_token = create_access_token({"sub": str(seller.id)})
             seller_headers = {"Authorization": f"Bearer {seller_token}"}
             
-            seller_url = seller.delta_sharing_server_url.rstrip('/')
+            seller_url = seller_server_url.rstrip('/')
             if os.getenv("DOCKER_ENV") == "true" and "localhost" in seller_url:
                 seller_url = seller_url.replace("localhost", "seller")
             
-            encrypt_response = requests.post(
+            encrypt_response = SELLER_HTTP_SESSION.post(
                 f"{seller_url}/seller/encrypt-token",
                 json={
                     "share_id": share.id,
@@ -400,7 +446,7 @@ async def request_trial(
             
             profile = generate_delta_sharing_profile(share, seller, None)
             share.profile_json = generate_profile_json(profile)
-            share.profile_generated_at = datetime.utcnow()
+            share.profile_generated_at = now
             db.commit()
         except requests.exceptions.RequestException as e:
             db.delete(share)
@@ -412,61 +458,60 @@ async def request_trial(
         except Exception as e:
             print(f"Warning: Failed to generate profile for trial: {e}")
     
-    seller_server_url = seller.delta_sharing_server_url if seller else None
-    
-    return TrialResponse(
-        id=share.id,
-        buyer_id=share.buyer_id,
-        dataset_id=share.dataset_id,
-        share_id=share.id,
-        share_token=None,
-        approval_status=share.approval_status,
-        seller_server_url=seller_server_url,
-        is_trial=True,
-        trial_row_limit=row_limit,
-        trial_expires_at=expires_at
-    )
+    return ORJSONResponse({
+        "id": share.id,
+        "buyer_id": share.buyer_id,
+        "dataset_id": share.dataset_id,
+        "share_id": share.id,
+        "share_token": None,
+        "approval_status": share.approval_status,
+        "seller_server_url": seller_server_url,
+        "is_trial": True,
+        "trial_row_limit": row_limit,
+        "trial_expires_at": expires_at
+    })
 
 @app.get("/my-datasets", response_model=list[DatasetResponse])
-async def get_my_datasets(
+def get_my_datasets(
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
 ):
-    datasets = db.query(Dataset).filter(Dataset.seller_id == current_user.id).all()
-    return datasets
+    rows = db.query(*DATASET_RESPONSE_COLUMNS).filter(Dataset.seller_id == current_user.id).all()
+    return ORJSONResponse([row._asdict() for row in rows])
 
 @app.get("/my-shares", response_model=list[ShareResponse])
-async def get_my_shares(
+def get_my_shares(
+    limit: int = MY_SHARES_PAGE_SIZE,
+    cursor: Optional[int] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    shares = db.query(Share).filter(
+    query = db.query(
+        Share.id, Share.dataset_id, Dataset.name.label("dataset_name"), Share.seller_id, Share.buyer_id,
+        Share.token, Share.created_at, Share.expires_at, Share.approval_status, Share.revoked, Share.revoked_at
+    ).join(Dataset, Share.dataset_id == Dataset.id).filter(
         or_(Share.seller_id == current_user.id, Share.buyer_id == current_user.id)
-    ).all()
-    return [
-        ShareResponse(
-            id=share.id,
-            dataset_id=share.dataset_id,
-            dataset_name=share.dataset.name,
-            seller_id=share.seller_id,
-            buyer_id=share.buyer_id,
-            token=share.token if share.token else "[REDACTED]",
-            created_at=share.created_at,
-            expires_at=share.expires_at,
-            approval_status=share.approval_status,
-            revoked=share.revoked,
-            revoked_at=share.revoked_at
-        )
-        for share in shares
-    ]
+    )
+    if cursor is not None:
+        query = query.filter(Share.id > cursor)
+    page_size = max(1, min(limit, MY_SHARES_PAGE_SIZE))
+    rows = query.order_by(Share.id).limit(page_size).all()
+    headers = {NEXT_CURSOR_HEADER: str(rows[-1].id)} if len(rows) == page_size else None
+    return ORJSONResponse([
+        {**row._asdict(), "token": row.token or "[REDACTED]"}
+        for row in rows
+    ], headers=headers)
 
 @app.post("/shares/{share_id}/rotate-token", response_model=TokenRotationResponse, status_code=status.HTTP_200_OK)
-async def rotate_share_token(
+def rotate_share_token(
     share_id: int,
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
 ):
-    share = db.query(Share).filter(Share.id == share_id).first()
+    share = db.query(Share).options(
+        joinedload(Share.buyer),
+        joinedload(Share.seller)
+    ).filter(Share.id == share_id).first()
     if not share:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -485,7 +530,6 @@ async def rotate_share_token(
             detail="Cannot rotate token for revoked share"
         )
     
-    settings = get_settings()
     rotation_recommended = should_rotate_token(
         share.created_at,
         share.last_used_at,
@@ -493,14 +537,14 @@ async def rotate_share_token(
         settings.TOKEN_INACTIVITY_DAYS
     )
     
-    buyer = db.query(User).filter(User.id == share.buyer_id).first()
+    buyer = share.buyer
     if not buyer or not buyer.public_key:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Buyer must have a registered public key for token rotation"
         )
     
-    seller = db.query(User).filter(User.id == share.seller_id).first()
+    seller = share.seller
     if seller and seller.delta_sharing_server_url:
         try:
             seller_token = create_access_token({"sub": str(seller.id)})
@@ -510,7 +554,7 @@ async def rotate_share_token(
             if os.getenv("DOCKER_ENV") == "true" and "localhost" in seller_url:
                 seller_url = seller_url.replace("localhost", "seller")
             
-            encrypt_response = requests.post(
+            encrypt_response = SELLER_HTTP_SESSION.post(
                 f"{seller_url}/seller/encrypt-token",
                 json={
                     "share_id": share_id,
@@ -530,7 +574,7 @@ async def rotate_share_token(
             
             profile = generate_delta_sharing_profile(share, seller, None)
             share.profile_json = generate_profile_json(profile)
-            share.profile_generated_at = datetime.utcnow()
+            share.profile_generated_at = share.token_rotated_at
             db.commit()
         except requests.exceptions.RequestException as e:
             raise HTTPException(
@@ -549,29 +593,25 @@ async def rotate_share_token(
     )
 
 @app.delete("/shares/{share_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def revoke_share(
+def revoke_share(
     share_id: int,
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
 ):
-    share = db.query(Share).filter(Share.id == share_id).first()
-    if not share:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Share not found"
-        )
-    
-    if share.seller_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You can only revoke your own shares"
-        )
-    
-    share.revoked = True
-    share.revoked_at = datetime.utcnow()
-    share.profile_json = None
     try:
+        updated = db.query(Share).filter(
+            Share.id == share_id,
+            Share.seller_id == current_user.id
+        ).update({
+            Share.revoked: True,
+            Share.revoked_at: datetime.utcnow(),
+            Share.profile_json: None
+        }, synchronize_session=False)
+        if not updated:
+            raise_share_not_updated(db, share_id, "You can only revoke your own shares")
         db.commit()
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         import traceback
@@ -585,12 +625,15 @@ async def revoke_share(
     return None
 
 @app.post("/shares/{share_id}/approve", response_model=ApprovalResponse, status_code=status.HTTP_200_OK)
-async def approve_share(
+def approve_share(
     share_id: int,
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
 ):
-    share = db.query(Share).filter(Share.id == share_id).first()
+    share = db.query(Share).options(
+        joinedload(Share.buyer),
+        joinedload(Share.seller)
+    ).filter(Share.id == share_id).first()
     if not share:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -605,14 +648,14 @@ async def approve_share(
     
     share.approval_status = "approved"
     
-    buyer = db.query(User).filter(User.id == share.buyer_id).first()
+    buyer = share.buyer
     if not buyer or not buyer.public_key:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Buyer must register a public key before share can be approved"
         )
     
-    seller = db.query(User).filter(User.id == share.seller_id).first()
+    seller = share.seller
     if seller and seller.delta_sharing_server_url:
         try:
             seller_token = create_access_token({"sub": str(seller.id)})
@@ -622,7 +665,7 @@ async def approve_share(
             if os.getenv("DOCKER_ENV") == "true" and "localhost" in seller_url:
                 seller_url = seller_url.replace("localhost", "seller")
             
-            encrypt_response = requests.post(
+            encrypt_response = SELLER_HTTP_SESSION.post(
                 f"{seller_url}/seller/encrypt-token",
                 json={
                     "share_id": share_id,
@@ -650,47 +693,40 @@ async def approve_share(
         except Exception as e:
             print(f"Warning: Failed to generate profile on approval: {e}")
     
+    profile_generated = share.profile_json is not None
     db.commit()
     
     return ApprovalResponse(
         status="success",
         message="Share approved",
         share_id=share_id,
-        approval_status=share.approval_status,
-        profile_generated=share.profile_json is not None
+        approval_status="approved",
+        profile_generated=profile_generated
     )
 
 @app.post("/shares/{share_id}/reject", response_model=RejectionResponse, status_code=status.HTTP_200_OK)
-async def reject_share(
+def reject_share(
     share_id: int,
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
 ):
-    share = db.query(Share).filter(Share.id == share_id).first()
-    if not share:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Share not found"
-        )
-    
-    if share.seller_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You can only reject your own shares"
-        )
-    
-    share.approval_status = "rejected"
+    updated = db.query(Share).filter(
+        Share.id == share_id,
+        Share.seller_id == current_user.id
+    ).update({Share.approval_status: "rejected"}, synchronize_session=False)
+    if not updated:
+        raise_share_not_updated(db, share_id, "You can only reject your own shares")
     db.commit()
     
     return RejectionResponse(
         status="success",
         message="Share rejected",
         share_id=share_id,
-        approval_status=share.approval_status
+        approval_status="rejected"
     )
 
 @app.get("/shares/{share_id}/profile", response_model=ProfileResponse)
-async def get_share_profile(
+def get_share_profile(
     share_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -709,66 +745,69 @@ async def get_share_profile(
         )
     
     if not share.profile_json:
-        if share.approval_status != "approved":
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Profile not available. Share status: {share.approval_status}"
-            )
-        
-        seller = db.query(User).filter(User.id == share.seller_id).first()
-        if not seller or not seller.delta_sharing_server_url:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Seller server URL not configured"
-            )
-        
-        buyer = db.query(User).filter(User.id == share.buyer_id).first()
-        if not buyer or not buyer.public_key:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Buyer must register a public key before profile can be generated"
-            )
-        
-        try:
-            if not share.encrypted_token:
-                seller_token = create_access_token({"sub": str(seller.id)})
-                seller_headers = {"Authorization": f"Bearer {seller_token}"}
+        with PROFILE_GENERATION_LOCKS[share.id % len(PROFILE_GENERATION_LOCKS)]:
+            db.refresh(share)
+            if not share.profile_json:
+                if share.approval_status != "approved":
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"Profile not available. Share status: {share.approval_status}"
+                    )
                 
-                seller_url = seller.delta_sharing_server_url.rstrip('/')
-                if os.getenv("DOCKER_ENV") == "true" and "localhost" in seller_url:
-                    seller_url = seller_url.replace("localhost", "seller")
+                seller = db.query(User).filter(User.id == share.seller_id).first()
+                if not seller or not seller.delta_sharing_server_url:
+                    raise HTTPException(
+                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail="Seller server URL not configured"
+                    )
                 
-                encrypt_response = requests.post(
-                    f"{seller_url}/seller/encrypt-token",
-                    json={
-                        "share_id": share_id,
-                        "buyer_public_key": buyer.public_key,
-                        "buyer_id": buyer.id
-                    },
-                    headers=seller_headers,
-                    timeout=30
-                )
-                encrypt_response.raise_for_status()
-                encrypt_data = encrypt_response.json()
+                buyer = db.query(User).filter(User.id == share.buyer_id).first()
+                if not buyer or not buyer.public_key:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Buyer must register a public key before profile can be generated"
+                    )
                 
-                share.encrypted_token = encrypt_data["encrypted_token"]
-                share.token_hash = encrypt_data["token_hash"]
-                share.token = None
-            
-            profile = generate_delta_sharing_profile(share, seller, None)
-            share.profile_json = generate_profile_json(profile)
-            share.profile_generated_at = datetime.utcnow()
-            db.commit()
-        except requests.exceptions.RequestException as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Failed to encrypt token via seller server: {str(e)}"
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Failed to generate profile: {str(e)}"
-            )
+                try:
+                    if not share.encrypted_token:
+                        seller_token = create_access_token({"sub": str(seller.id)})
+                        seller_headers = {"Authorization": f"Bearer {seller_token}"}
+                        
+                        seller_url = seller.delta_sharing_server_url.rstrip('/')
+                        if os.getenv("DOCKER_ENV") == "true" and "localhost" in seller_url:
+                            seller_url = seller_url.replace("localhost", "seller")
+                        
+                        encrypt_response = SELLER_HTTP_SESSION.post(
+                            f"{seller_url}/seller/encrypt-token",
+                            json={
+                                "share_id": share_id,
+                                "buyer_public_key": buyer.public_key,
+                                "buyer_id": buyer.id
+                            },
+                            headers=seller_headers,
+                            timeout=30
+                        )
+                        encrypt_response.raise_for_status()
+                        encrypt_data = encrypt_response.json()
+                        
+                        share.encrypted_token = encrypt_data["encrypted_token"]
+                        share.token_hash = encrypt_data["token_hash"]
+                        share.token = None
+                    
+                    profile = generate_delta_sharing_profile(share, seller, None)
+                    share.profile_json = generate_profile_json(profile)
+                    share.profile_generated_at = datetime.utcnow()
+                    db.commit()
+                except requests.exceptions.RequestException as e:
+                    raise HTTPException(
+                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail=f"Failed to encrypt token via seller server: {str(e)}"
+                    )
+                except Exception as e:
+                    raise HTTPException(
+                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail=f"Failed to generate profile: {str(e)}"
+                    )
     
     return ProfileResponse(
         share_id=share.id,
@@ -777,34 +816,28 @@ async def get_share_profile(
     )
 
 @app.get("/my-profiles", response_model=list[ProfileListItem])
-async def get_my_profiles(
+def get_my_profiles(
     current_user: User = Depends(get_current_buyer),
     db: Session = Depends(get_db)
 ):
-    shares = db.query(Share).filter(
+    rows = db.query(
+        Share.id.label("share_id"), Share.dataset_id, Dataset.name.label("dataset_name"), Share.profile_json,
+        func.coalesce(Share.profile_generated_at, Share.created_at).label("generated_at"), Share.expires_at
+    ).join(Dataset, Share.dataset_id == Dataset.id).filter(
         Share.buyer_id == current_user.id,
         Share.approval_status == "approved",
-        Share.revoked == False
+        Share.revoked == False,
+        Share.profile_json != ""
     ).all()
     
-    profiles = []
-    for share in shares:
-        if share.profile_json:
-            profiles.append(ProfileListItem(
-                share_id=share.id,
-                dataset_id=share.dataset_id,
-                dataset_name=share.dataset.name,
-                profile_json=share.profile_json,
-                generated_at=share.profile_generated_at or share.created_at,
-                expires_at=share.expires_at
-            ))
-    
-    return profiles
+    return ORJSONResponse([row._asdict() for row in rows])
 
 @app.get("/usage-logs", response_model=list[UsageLogResponse])
-async def get_usage_logs(
+def get_usage_logs(
     dataset_id: Optional[int] = None,
     share_id: Optional[int] = None,
+    limit: int = USAGE_LOGS_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_seller),
     db: Session = Depends(get_db)
 ):
@@ -816,31 +849,38 @@ async def get_usage_logs(
     if share_id:
         query = query.filter(AuditLog.share_id == share_id)
     
-    logs = query.order_by(AuditLog.query_time.desc()).limit(100).all()
-    
-    return [
-        UsageLogResponse(
-            id=log.id,
-            buyer_id=log.buyer_id,
-            dataset_id=log.dataset_id,
-            share_id=log.share_id,
-            query_time=log.query_time,
-            columns_requested=log.columns_requested,
-            row_count_returned=log.row_count_returned,
-            query_limit=log.query_limit,
-            ip_address=log.ip_address
-        )
-        for log in logs
-    ]
+    if cursor is not None:
+        cursor_time, _, cursor_id = cursor.partition("_")
+        try:
+            cursor_time = datetime.fromisoformat(cursor_time)
+            cursor_id = int(cursor_id) if cursor_id else None
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+        if cursor_id is None:
+            query = query.filter(AuditLog.query_time < cursor_time)
+        else:
+            query = query.filter(tuple_(AuditLog.query_time, AuditLog.id) < tuple_(cursor_time, cursor_id))
+    
+    page_size = max(1, min(limit, USAGE_LOGS_PAGE_SIZE))
+    rows = query.with_entities(
+        AuditLog.id, AuditLog.buyer_id, AuditLog.dataset_id, AuditLog.share_id, AuditLog.query_time,
+        AuditLog.columns_requested, AuditLog.row_count_returned, AuditLog.query_limit, AuditLog.ip_address
+    ).order_by(AuditLog.query_time.desc(), AuditLog.id.desc()).limit(page_size).all()
+    
+    headers = {NEXT_CURSOR_HEADER: f"{rows[-1].query_time.isoformat()}_{rows[-1].id}"} if len(rows) == page_size else None
+    return ORJSONResponse([row._asdict() for row in rows], headers=headers)
 
 @app.post("/shares/{share_id}/file-download", response_model=FileDownloadResponse)
-async def request_file_download(
+def request_file_download(
     share_id: int,
     request: FileDownloadRequest,
     current_user: User = Depends(get_current_buyer),
     db: Session = Depends(get_db)
 ):
-    share = db.query(Share).filter(Share.id == share_id).first()
+    share = db.query(Share).options(joinedload(Share.seller)).filter(Share.id == share_id).first()
     if not share:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -865,7 +905,7 @@ async def request_file_download(
             detail="Share has been revoked"
         )
     
-    seller = db.query(User).filter(User.id == share.seller_id).first()
+    seller = share.seller
     if not seller or not seller.delta_sharing_server_url:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -879,7 +919,7 @@ async def request_file_download(
         seller_url = seller.delta_sharing_server_url.rstrip('/')
         if os.getenv("DOCKER_ENV") == "true" and "localhost" in seller_url:
             seller_url = seller_url.replace("localhost", "seller")
-        response = requests.post(
+        response = SELLER_HTTP_SESSION.post(
             f"{seller_url}/seller/file-download/{share_id}",
             json={"expiry_hours": request.expiry_hours},
             headers=seller_headers,
@@ -894,7 +934,7 @@ async def request_file_download(
         )
 
 @app.delete("/shares/{share_id}/file-download/{snapshot_id}", response_model=FileDownloadRevokeResponse)
-async def revoke_file_download(
+def revoke_file_download(
     share_id: int,
     snapshot_id: str,
     current_user: User = Depends(get_current_seller),
@@ -913,7 +953,7 @@ async def revoke_file_download(
             detail="You can only revoke file downloads for your own shares"
         )
     
-    seller = db.query(User).filter(User.id == share.seller_id).first()
+    seller = current_user
     if not seller or not seller.delta_sharing_server_url:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -927,7 +967,7 @@ async def revoke_file_download(
         seller_url = seller.delta_sharing_server_url.rstrip('/')
         if os.getenv("DOCKER_ENV") == "true" and "localhost" in seller_url:
             seller_url = seller_url.replace("localhost", "seller")
-        response = requests.delete(
+        response = SELLER_HTTP_SESSION.delete(
             f"{seller_url}/seller/file-download/{snapshot_id}",
             headers=seller_headers,
             timeout=30
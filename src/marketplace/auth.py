@@ -1,27 +1,51 @@
+import hashlib
+import os
+import secrets
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import bindparam, select
 from sqlalchemy.orm import Session
 from src.models.database import SessionLocal, User, get_db
 from src.utils.settings import get_settings
 
 settings = get_settings()
-SECRET_KEY = settings.JWT_SECRET_KEY
+SIGNING_KEY = settings.get_jwt_signing_key()
+VERIFICATION_KEY = settings.get_jwt_verification_key()
 ALGORITHM = settings.JWT_ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.JWT_ACCESS_TOKEN_EXPIRE_MINUTES
 
-pwd_context = CryptContext(schemes=["bcrypt"])
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__time_cost=2,
+    argon2__memory_cost=19456,
+    argon2__parallelism=1
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+DUMMY_PASSWORD_HASH = pwd_context.hash(secrets.token_urlsafe(16))
+
+# Process-local: invalidate_cached_user only clears the worker that handled the update,
+# so with several uvicorn workers the cache is off unless USER_CACHE_TTL_SECONDS opts in.
+API_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30" if API_WORKERS <= 1 else "0"))
+USER_CACHE_MAX_SIZE = 10000
+USER_CACHE = {}
+ACCESS_TOKEN_CACHE_MAX_SIZE = 10000
+ACCESS_TOKEN_CACHE = {}
+USER_BY_ID = select(User).where(User.id == bindparam("user_id"))
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple:
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def get_password_hash(password: str) -> str:
-    if len(password.encode('utf-8')) > 72:
-        raise ValueError("Password cannot be longer than 72 bytes")
     return pwd_context.hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -31,29 +55,49 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, SIGNING_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id_str = payload.get("sub")
-        if user_id_str is None:
+    token_digest = hashlib.sha256(token.encode('utf-8')).digest()
+    decoded = ACCESS_TOKEN_CACHE.get(token_digest)
+    if decoded and decoded[1] > time.time():
+        user_id = decoded[0]
+    else:
+        try:
+            payload = jwt.decode(token, VERIFICATION_KEY, algorithms=[ALGORITHM])
+            user_id_str = payload.get("sub")
+            if user_id_str is None:
+                raise credentials_exception
+            user_id = int(user_id_str)
+        except (JWTError, ValueError, TypeError):
             raise credentials_exception
-        user_id = int(user_id_str)
-    except (JWTError, ValueError, TypeError):
-        raise credentials_exception
-    user = db.query(User).filter(User.id == user_id).first()
+        if isinstance(payload.get("exp"), (int, float)):
+            if len(ACCESS_TOKEN_CACHE) >= ACCESS_TOKEN_CACHE_MAX_SIZE:
+                ACCESS_TOKEN_CACHE.clear()
+            ACCESS_TOKEN_CACHE[token_digest] = (user_id, payload["exp"])
+    cached = USER_CACHE.get(user_id)
+    if cached and time.monotonic() - cached[0] < USER_CACHE_TTL_SECONDS:
+        return cached[1]
+    
+    user = db.execute(USER_BY_ID, {"user_id": user_id}).scalar_one_or_none()
     if user is None:
         raise credentials_exception
+    db.expunge(user)
+    if len(USER_CACHE) >= USER_CACHE_MAX_SIZE:
+        USER_CACHE.clear()
+    USER_CACHE[user_id] = (time.monotonic(), user)
     return user
 
+def invalidate_cached_user(user_id: int):
+    USER_CACHE.pop(user_id, None)
+
 async def get_current_seller(current_user: User = Depends(get_current_user)) -> User:
     if current_user.role != "seller":
         raise HTTPException(
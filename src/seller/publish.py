@@ -5,10 +5,10 @@ from typing import Dict, Any, Optional
 from datetime import datetime
 import pandas as pd
 import pyarrow as pa
-from deltalake import DeltaTable
 from src.seller.pii_detection import analyze_dataset_for_pii
 from src.seller.watermarking import detect_anchor_columns_from_schema
 from src.utils.s3_utils import get_delta_storage_options, get_full_s3_path, get_bucket_name
+from src.utils.delta_sharing_utils import get_cached_delta_table, get_cached_arrow_dataset
 from src.utils.settings import get_settings
 
 def generate_metadata_signature(metadata_dict: Dict[str, Any], seller_id: int) -> str:
@@ -33,8 +33,8 @@ def publish_dataset_metadata(
     full_table_path = get_full_s3_path(bucket_name, table_path)
     storage_options = get_delta_storage_options()
     
-    delta_table = DeltaTable(full_table_path, storage_options=storage_options)
-    arrow_dataset = delta_table.to_pyarrow_dataset()
+    delta_table = get_cached_delta_table(full_table_path, storage_options)
+    arrow_dataset, _ = get_cached_arrow_dataset(full_table_path, delta_table.version(), delta_table)
     schema = arrow_dataset.schema
     
     schema_fields = []
@@ -46,7 +46,7 @@ def publish_dataset_metadata(
         }
         schema_fields.append(field_dict)
     
-    sample_df = delta_table.to_pandas().head(100)
+    sample_df = arrow_dataset.head(100).to_pandas()
     
     sensitive_columns_dict, pii_types_dict, risk_score, risk_level = analyze_dataset_for_pii(sample_df)
     
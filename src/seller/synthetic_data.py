@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import numpy as np
 import pyarrow as pa
@@ -19,7 +20,7 @@ def generate_synthetic_data(
     
     try:
         delta_table = DeltaTable(full_original_path, storage_options=storage_options)
-        original_df = delta_table.to_pandas()
+        original_df = delta_table.to_pyarrow_table().to_pandas(self_destruct=True, split_blocks=True)
         schema = delta_table.schema()
     except Exception as e:
         raise ValueError(f"Failed to read original table: {str(e)}")
@@ -55,7 +56,7 @@ def generate_synthetic_data(
         synthetic_df[col_name] = synthetic_col
     
     full_output_path = get_full_s3_path(get_bucket_name(), output_table_path)
-    table = pa.Table.from_pandas(synthetic_df)
+    table = pa.Table.from_pandas(synthetic_df, nthreads=os.cpu_count())
     
     write_deltalake(
         full_output_path,
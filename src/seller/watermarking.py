@@ -5,6 +5,9 @@ import random
 import traceback
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import numpy as np
 from datetime import datetime, timedelta
 from deltalake import write_deltalake, DeltaTable
@@ -274,6 +277,142 @@ def apply_watermark_to_dataframe(df: pd.DataFrame, watermark: str, is_trial: boo
     
     return df
 
+def normalize_arrow_column_for_anchor(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    column_type = column.type
+    has_nulls = column.null_count > 0
+    
+    if pa.types.is_integer(column_type) and not has_nulls:
+        return pc.cast(column, pa.string())
+    elif pa.types.is_string(column_type) or pa.types.is_large_string(column_type):
+        return pc.fill_null(pc.cast(column, pa.string()), 'NULL')
+    elif pa.types.is_boolean(column_type) and not has_nulls:
+        return pc.if_else(column, 'TRUE', 'FALSE')
+    
+    values = column.to_pylist()
+    if pa.types.is_integer(column_type):
+        normalized = ['NULL' if v is None else f"{float(v):.10f}" for v in values]
+    elif pa.types.is_floating(column_type):
+        normalized = ['NULL' if v is None or v != v else f"{float(v):.10f}" for v in values]
+    elif pa.types.is_timestamp(column_type):
+        normalized = ['NULL' if v is None else v.strftime('%Y-%m-%dT%H:%M:%S.%f') for v in values]
+    else:
+        normalized = ['NULL' if v is None else str(v) for v in values]
+    return pa.chunked_array([pa.array(normalized, type=pa.string())])
+
+def compute_row_anchors_arrow(table: pa.Table, anchor_columns: list = None) -> np.ndarray:
+    available_cols = [name for name in table.column_names if name != '_watermark_id']
+    if anchor_columns:
+        cols_to_use = sorted(col for col in anchor_columns if col in available_cols)
+        if not cols_to_use:
+            raise ValueError(f"None of the anchor columns are available in table. Requested: {anchor_columns}, Available: {available_cols}")
+    else:
+        cols_to_use = sorted(available_cols)
+    
+    parts = [
+        pc.binary_join_element_wise(f"{col}:", normalize_arrow_column_for_anchor(table.column(col)), '')
+        for col in cols_to_use
+    ]
+    row_strings = pc.cast(pc.binary_join_element_wise(*parts, '|'), pa.binary()).to_pylist()
+    
+    return np.fromiter(
+        (int.from_bytes(hashlib.sha256(row).digest()[:8], 'big') for row in row_strings),
+        dtype=np.uint64,
+        count=len(row_strings)
+    )
+
+def is_timestamp_like_string_column(column: pa.ChunkedArray) -> bool:
+    non_null = column.drop_null()
+    if len(non_null) == 0:
+        return False
+    sample_val = non_null[0].as_py()
+    if not sample_val or not isinstance(sample_val, str):
+        return False
+    if 'T' in sample_val or ('-' in sample_val[:10] and len(sample_val) > 10):
+        try:
+            pd.to_datetime(sample_val)
+            return True
+        except:
+            return False
+    return False
+
+def dataset_needs_watermarking(arrow_dataset: ds.Dataset) -> bool:
+    for field in arrow_dataset.schema:
+        if pa.types.is_timestamp(field.type):
+            return True
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            first_value = arrow_dataset.scanner(columns=[field.name], filter=ds.field(field.name).is_valid()).head(1)
+            if is_timestamp_like_string_column(first_value.column(0)):
+                return True
+    return False
+
+def apply_watermark_to_arrow_table(table: pa.Table, watermark: str, is_trial: bool = False, anchor_columns: list = None) -> pa.Table:
+    if table.num_rows == 0:
+        return table
+    
+    watermark_seed = int(watermark[:8], 16)
+    watermark_bytes = np.array([int(watermark[i:i+2], 16) for i in range(0, min(16, len(watermark)), 2)], dtype=np.int64)
+    
+    row_anchors = compute_row_anchors_arrow(table, anchor_columns)
+    
+    timestamp_cols = []
+    for field in table.schema:
+        if field.name == '_watermark_id':
+            continue
+        if pa.types.is_timestamp(field.type):
+            timestamp_cols.append(field.name)
+        elif (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)) and is_timestamp_like_string_column(table.column(field.name)):
+            timestamp_cols.append(field.name)
+    
+    if is_trial:
+        table = table.append_column('_watermark_id', pa.array((row_anchors % 1000000).astype(np.int64)))
+    
+    if not timestamp_cols:
+        return table
+    
+    anchor_bytes = (row_anchors % len(watermark_bytes)).astype(np.int64)
+    target_microseconds = (watermark_bytes[anchor_bytes] * 12500 + watermark_seed % 10000) % 1000000
+    
+    for col in timestamp_cols:
+        index = table.schema.get_field_index(col)
+        column = table.column(col)
+        
+        if not pa.types.is_timestamp(column.type):
+            column = pa.chunked_array([pa.array(pd.to_datetime(column.to_pandas()))])
+        if column.type.unit in ('s', 'ms'):
+            column = column.cast(pa.timestamp('us', tz=column.type.tz))
+        
+        if column.null_count == len(column):
+            continue
+        
+        unit_factor = 1000 if column.type.unit == 'ns' else 1
+        offsets = pa.array(target_microseconds * unit_factor, type=pa.duration(column.type.unit))
+        base_ts = pc.floor_temporal(column, unit='second')
+        watermarked_ts = pc.add(base_ts, offsets)
+        
+        table = table.set_column(index, pa.field(col, watermarked_ts.type), watermarked_ts)
+    
+    return table
+
+def serialize_arrow_table(table: pa.Table) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def encode_watermarked_parquet(ipc_bytes: bytes, watermark: str, is_trial: bool, anchor_columns: list, columns_to_return: list, parquet_options: dict) -> tuple:
+    table = pa.ipc.open_stream(pa.py_buffer(ipc_bytes)).read_all()
+    table = apply_watermark_to_arrow_table(table, watermark, is_trial=is_trial, anchor_columns=anchor_columns)
+    
+    if anchor_columns and table.num_rows > 1:
+        table = table.sort_by([(anchor_columns[0], "ascending")])
+    
+    if columns_to_return:
+        table = table.select([col for col in columns_to_return if col in table.column_names])
+    
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, row_group_size=max(1, min(parquet_options.pop('max_row_group_size'), table.num_rows)), **parquet_options)
+    return sink.getvalue().to_pybytes(), table.num_rows, table.column_names
+
 def create_watermarked_table(
     dataset: Dataset,
     buyer_id: int,
@@ -291,9 +430,9 @@ def create_watermarked_table(
     
     try:
         delta_table = DeltaTable(original_table_path, storage_options=storage_options)
-        df = delta_table.to_pandas()
+        table = delta_table.to_pyarrow_table()
         
-        if df.empty:
+        if table.num_rows == 0:
             raise Exception("Original table is empty")
         
         try:
@@ -302,12 +441,9 @@ def create_watermarked_table(
             anchor_cols = None
             if dataset.anchor_columns:
                 anchor_cols = [col.strip() for col in dataset.anchor_columns.split(',') if col.strip()]
-            df = apply_watermark_to_dataframe(df, watermark, is_trial=is_trial, anchor_columns=anchor_cols)
+            table = apply_watermark_to_arrow_table(table, watermark, is_trial=is_trial, anchor_columns=anchor_cols)
         except Exception as watermark_error:
             print(f"Warning: Watermarking failed: {watermark_error}")
-            df = df.copy()
-        
-        table = pa.Table.from_pandas(df)
         
         write_deltalake(
             full_watermarked_path,
@@ -341,6 +477,7 @@ def update_watermarked_tables(
     
     bucket_name = get_bucket_name()
     storage_options = get_delta_storage_options()
+    new_table = pa.Table.from_pandas(new_data, preserve_index=False, nthreads=os.cpu_count())
     
     for share in shares:
         try:
@@ -360,15 +497,13 @@ def update_watermarked_tables(
             anchor_cols = None
             if dataset.anchor_columns:
                 anchor_cols = [col.strip() for col in dataset.anchor_columns.split(',') if col.strip()]
-            watermarked_data = apply_watermark_to_dataframe(new_data, watermark, is_trial=share.is_trial, anchor_columns=anchor_cols)
+            table = apply_watermark_to_arrow_table(new_table, watermark, is_trial=share.is_trial, anchor_columns=anchor_cols)
             
             full_watermarked_path = get_full_s3_path(
                 bucket_name,
                 share.watermarked_table_path
             )
             
-            table = pa.Table.from_pandas(watermarked_data)
-            
             write_deltalake(
                 full_watermarked_path,
                 table,
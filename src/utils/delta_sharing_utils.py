@@ -1,11 +1,22 @@
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import or_, bindparam, select
+from sqlalchemy.orm import Session, joinedload
 from typing import Optional
-from datetime import datetime, timedelta
+from datetime import datetime
+from functools import lru_cache
+from deltalake import DeltaTable
+from botocore.exceptions import ClientError
+import hashlib
+import json
+import orjson
 import os
-from src.models.database import Share, Dataset
+import threading
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.models.database import SessionLocal, Share, Dataset
 from src.utils.s3_utils import get_full_s3_path
-from src.utils.token_utils import verify_token_hash, is_token_expired
+from src.utils.token_utils import hash_token, is_token_expired, verify_share_token
 
 SELLER_ID = os.getenv("SELLER_ID", None)
 if SELLER_ID and SELLER_ID.strip():
@@ -16,6 +27,35 @@ if SELLER_ID and SELLER_ID.strip():
 else:
     SELLER_ID = None
 
+DELTA_TABLE_CACHE_TTL_SECONDS = float(os.getenv("DELTA_TABLE_CACHE_TTL_SECONDS", "5"))
+DELTA_TABLE_CACHE = {}
+DELTA_TABLE_CACHE_LOCK = threading.Lock()
+DELTA_TABLE_LOAD_LOCKS = {}
+TABLE_METADATA_CACHE_MAX_SIZE = 256
+TABLE_METADATA_CACHE = {}
+ARROW_DATASET_CACHE_MAX_SIZE = 256
+ARROW_DATASET_CACHE = {}
+
+WATERMARK_CACHE_TAG = "derived=watermarked"
+WATERMARK_CACHE_RULE_ID = "watermark-cache-expiration"
+WATERMARK_CACHE_EXPIRATION_DAYS = 1
+PARQUET_FOOTER_READ_BYTES = 64 * 1024
+
+SHARE_TOKEN_CACHE_TTL_SECONDS = float(os.getenv("SHARE_TOKEN_CACHE_TTL_SECONDS", "30"))
+SHARE_TOKEN_CACHE_MAX_SIZE = 10000
+SHARE_TOKEN_CACHE = {}
+SHARE_SNAPSHOT_CACHE = {}
+SHARE_LAST_USED_UPDATE_SECONDS = 60
+SHARE_STATUS_BY_ID = select(
+    Share.seller_id, Share.token_hash, Share.revoked, Share.expires_at,
+    Share.is_trial, Share.trial_expires_at, Share.approval_status
+).where(Share.id == bindparam("share_id"))
+
+PRESIGNED_URL_EXPIRES_SECONDS = 3600
+PRESIGNED_URL_CACHE_TTL_SECONDS = PRESIGNED_URL_EXPIRES_SECONDS * 0.9
+PRESIGNED_URL_CACHE_MAX_SIZE = 10000
+PRESIGNED_URL_CACHE = {}
+
 def extract_token_from_header(authorization: Optional[str]) -> str:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid authorization")
@@ -30,7 +70,7 @@ def validate_share_access(share_name: str, share: Share) -> int:
     return share_id
 
 def get_dataset(share: Share, db: Session) -> Dataset:
-    dataset = db.query(Dataset).filter(Dataset.id == share.dataset_id).first()
+    dataset = db.get(Dataset, share.dataset_id)
     if not dataset:
         raise HTTPException(status_code=404, detail="Dataset not found")
     return dataset
@@ -54,55 +94,203 @@ def transform_schema_for_timestamp_ntz(schema_obj: dict) -> dict:
                         field['type'] = {'type': 'string'}
     return schema_obj
 
+def build_shared_schema_string(shared_schema_fields: list, columns: list) -> str:
+    column_set = set(columns)
+    filtered_fields = [field for field in shared_schema_fields if field.get('name') in column_set]
+    
+    if not filtered_fields:
+        raise ValueError(f"No columns from watermarked table found in original schema. watermarked table columns: {list(columns)}, original schema fields: {[f.get('name') for f in shared_schema_fields]}")
+    
+    return orjson.dumps({
+        "type": "struct",
+        "fields": filtered_fields
+    }).decode()
+
 def get_presigned_url(s3_client, bucket: str, key: str, endpoint_for_client: str, is_localstack: bool) -> str:
     if is_localstack:
         return f"{endpoint_for_client}/{bucket}/{key}"
     else:
+        cache_key = (bucket, key, endpoint_for_client)
+        cached = PRESIGNED_URL_CACHE.get(cache_key)
+        now = time.monotonic()
+        if cached and now < cached[0]:
+            return cached[1]
         try:
             presigned_url = s3_client.generate_presigned_url(
                 'get_object',
                 Params={'Bucket': bucket, 'Key': key},
-                ExpiresIn=3600
+                ExpiresIn=PRESIGNED_URL_EXPIRES_SECONDS
             )
             if 'localstack:4566' in presigned_url:
                 presigned_url = presigned_url.replace('localstack:4566', 'localhost:4566')
+            if len(PRESIGNED_URL_CACHE) >= PRESIGNED_URL_CACHE_MAX_SIZE:
+                PRESIGNED_URL_CACHE.clear()
+            PRESIGNED_URL_CACHE[cache_key] = (now + PRESIGNED_URL_CACHE_TTL_SECONDS, presigned_url)
             return presigned_url
         except Exception:
             return f"{endpoint_for_client}/{bucket}/{key}"
 
-def cleanup_old_watermarked_files(s3_client, bucket: str, prefix: str, max_age_hours: int = 1):
+def list_object_sizes(s3_client, bucket: str, prefix: str) -> dict:
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return {
+        obj['Key']: obj['Size']
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get('Contents', [])
+    }
+
+def get_cached_delta_table(table_path: str, storage_options: dict) -> DeltaTable:
+    cached = DELTA_TABLE_CACHE.get(table_path)
+    if cached and time.monotonic() - cached[0] < DELTA_TABLE_CACHE_TTL_SECONDS:
+        return cached[1]
+    
+    with DELTA_TABLE_CACHE_LOCK:
+        table_lock = DELTA_TABLE_LOAD_LOCKS.setdefault(table_path, threading.Lock())
+    
+    with table_lock:
+        cached = DELTA_TABLE_CACHE.get(table_path)
+        if cached and time.monotonic() - cached[0] < DELTA_TABLE_CACHE_TTL_SECONDS:
+            return cached[1]
+        
+        delta_table = DeltaTable(table_path, storage_options=storage_options)
+        DELTA_TABLE_CACHE[table_path] = (time.monotonic(), delta_table)
+        return delta_table
+
+def load_table_metadata(table_path: str, storage_options: dict) -> dict:
+    delta_table = get_cached_delta_table(table_path, storage_options)
+    cache_key = (table_path, delta_table.version())
+    table_metadata = TABLE_METADATA_CACHE.get(cache_key)
+    if table_metadata:
+        return table_metadata
+    
+    metadata = delta_table.metadata()
+    schema_string = delta_table.schema().to_json()
+    table_metadata = {
+        "version": cache_key[1],
+        "id": getattr(metadata, 'id', None),
+        "schema_string": schema_string,
+        "shared_schema_fields": transform_schema_for_timestamp_ntz(json.loads(schema_string)).get('fields', []),
+        "partition_columns": getattr(metadata, 'partition_columns', None) or []
+    }
+    if len(TABLE_METADATA_CACHE) >= TABLE_METADATA_CACHE_MAX_SIZE:
+        TABLE_METADATA_CACHE.clear()
+    TABLE_METADATA_CACHE[cache_key] = table_metadata
+    return table_metadata
+
+def get_cached_arrow_dataset(table_path: str, table_version: int, delta_table: DeltaTable) -> tuple:
+    cache_key = (table_path, table_version)
+    cached = ARROW_DATASET_CACHE.get(cache_key)
+    if cached:
+        return cached
+    
+    arrow_dataset = delta_table.to_pyarrow_dataset()
+    cached = (arrow_dataset, frozenset(arrow_dataset.schema.names))
+    if len(ARROW_DATASET_CACHE) >= ARROW_DATASET_CACHE_MAX_SIZE:
+        ARROW_DATASET_CACHE.clear()
+    ARROW_DATASET_CACHE[cache_key] = cached
+    return cached
+
+@lru_cache(maxsize=1024)
+def parse_anchor_columns(anchor_columns: str) -> tuple:
+    return tuple(col.strip() for col in anchor_columns.split(',') if col.strip())
+
+def list_table_files(delta_table: DeltaTable) -> list:
+    actions = delta_table.get_add_actions(flatten=True).to_pydict()
+    partition_fields = [name for name in actions if name.startswith('partition.')]
+    num_records = actions.get('num_records') or [None] * len(actions['path'])
+    return [
+        {
+            "path": path,
+            "size": actions['size_bytes'][i],
+            "num_records": num_records[i] or 0,
+            "partition_values": {
+                name[len('partition.'):]: None if actions[name][i] is None else str(actions[name][i])
+                for name in partition_fields
+            }
+        }
+        for i, path in enumerate(actions['path'])
+    ]
+
+def get_watermark_cache_key(table_prefix: str, share_id: int, table_version: int, watermark: str, columns: set, body: dict, limit: Optional[int]) -> str:
+    cache_source = json.dumps({
+        "share_id": share_id,
+        "version": table_version,
+        "watermark": watermark,
+        "columns": sorted(columns),
+        "predicateHints": body.get("predicateHints"),
+        "jsonPredicateHints": body.get("jsonPredicateHints"),
+        "limit": limit
+    }, sort_keys=True, default=str)
+    cache_hash = hashlib.sha256(cache_source.encode('utf-8')).hexdigest()[:32]
+    return f"{table_prefix}/_wm_cache/{share_id}_{table_version}_{cache_hash}.parquet"
+
+def head_cached_object(s3_client, bucket: str, key: str) -> Optional[dict]:
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError:
+        return None
+
+def read_cached_parquet_columns(s3_client, bucket: str, key: str, content_length: int) -> list:
+    tail = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=-{min(content_length, PARQUET_FOOTER_READ_BYTES)}")['Body'].read()
+    footer_length = int.from_bytes(tail[-8:-4], 'little') + 8
+    if footer_length > len(tail):
+        tail = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=-{footer_length}")['Body'].read()
+    return pq.read_metadata(pa.BufferReader(b"PAR1" + tail[-footer_length:])).schema.to_arrow_schema().names
+
+def ensure_watermark_cache_expiration(s3_client, bucket: str):
     try:
-        paginator = s3_client.get_paginator('list_objects_v2')
-        cutoff_time = datetime.utcnow() - timedelta(hours=max_age_hours)
-        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    if obj['Key'].startswith(prefix) and obj['Key'].endswith('.parquet'):
-                        if obj['LastModified'].replace(tzinfo=None) < cutoff_time:
-                            try:
-                                s3_client.delete_object(Bucket=bucket, Key=obj['Key'])
-                            except Exception:
-                                pass
-    except Exception:
-        pass
+        try:
+            rules = s3_client.get_bucket_lifecycle_configuration(Bucket=bucket).get('Rules', [])
+        except ClientError:
+            rules = []
+        rules = [rule for rule in rules if rule.get('ID') != WATERMARK_CACHE_RULE_ID]
+        tag_key, tag_value = WATERMARK_CACHE_TAG.split('=', 1)
+        rules.append({
+            'ID': WATERMARK_CACHE_RULE_ID,
+            'Filter': {'Tag': {'Key': tag_key, 'Value': tag_value}},
+            'Status': 'Enabled',
+            'Expiration': {'Days': WATERMARK_CACHE_EXPIRATION_DAYS}
+        })
+        s3_client.put_bucket_lifecycle_configuration(
+            Bucket=bucket,
+            LifecycleConfiguration={'Rules': rules}
+        )
+    except Exception as e:
+        print(f"Warning: Could not configure watermark cache expiration on {bucket}: {e}")
 
 def get_share_from_token(token: str, db: Session) -> Share:
-    shares = db.query(Share).filter(Share.revoked == False).all()
-    
-    matching_share = None
-    for share in shares:
-        if share.token and share.token == token:
-            matching_share = share
-            break
-        elif share.token_hash and verify_token_hash(token, share.token_hash):
-            matching_share = share
-            break
-    
-    if not matching_share:
+    if verify_share_token(token) is None:
         raise HTTPException(status_code=401, detail="Invalid share token")
     
-    share = matching_share
+    token_hash = hash_token(token)
+    
+    share = None
+    cached = SHARE_TOKEN_CACHE.get(token_hash)
+    if cached and time.monotonic() - cached[0] < SHARE_TOKEN_CACHE_TTL_SECONDS:
+        share = db.get(Share, cached[1], options=[joinedload(Share.dataset)])
+        if share and share.token_hash != token_hash and share.token != token:
+            share = None
+    
+    if share is None:
+        share = db.query(Share).options(joinedload(Share.dataset)).filter(
+            Share.revoked == False,
+            or_(Share.token_hash == token_hash, Share.token == token)
+        ).first()
+        if not share:
+            raise HTTPException(status_code=401, detail="Invalid share token")
+        if len(SHARE_TOKEN_CACHE) >= SHARE_TOKEN_CACHE_MAX_SIZE:
+            SHARE_TOKEN_CACHE.clear()
+        SHARE_TOKEN_CACHE[token_hash] = (time.monotonic(), share.id)
     
+    check_share_status(share)
+    
+    now = datetime.utcnow()
+    if not share.last_used_at or (now - share.last_used_at).total_seconds() >= SHARE_LAST_USED_UPDATE_SECONDS:
+        share.last_used_at = now
+        db.commit()
+    
+    return share
+
+def check_share_status(share: Share):
     if SELLER_ID is not None and share.seller_id != SELLER_ID:
         raise HTTPException(status_code=403, detail="This server only serves shares for its configured seller")
     
@@ -117,9 +305,27 @@ def get_share_from_token(token: str, db: Session) -> Share:
     
     if share.approval_status != "approved":
         raise HTTPException(status_code=403, detail=f"Share is {share.approval_status}, not approved")
+
+def get_cached_share_from_token(token: str) -> Share:
+    token_hash = hash_token(token)
+    cached = SHARE_SNAPSHOT_CACHE.get(token_hash)
+    db = SessionLocal()
+    try:
+        if cached and time.monotonic() - cached[0] < SHARE_TOKEN_CACHE_TTL_SECONDS:
+            status = db.execute(SHARE_STATUS_BY_ID, {"share_id": cached[1].id}).first()
+            if status is None or (status.token_hash != token_hash and cached[1].token != token):
+                SHARE_SNAPSHOT_CACHE.pop(token_hash, None)
+                raise HTTPException(status_code=401, detail="Invalid share token")
+            check_share_status(status)
+            return cached[1]
+        
+        share = get_share_from_token(token, db)
+        db.expunge(share)
+    finally:
+        db.close()
     
-    share.last_used_at = datetime.utcnow()
-    db.commit()
-    
+    if len(SHARE_SNAPSHOT_CACHE) >= SHARE_TOKEN_CACHE_MAX_SIZE:
+        SHARE_SNAPSHOT_CACHE.clear()
+    SHARE_SNAPSHOT_CACHE[token_hash] = (time.monotonic(), share)
     return share
 
@@ -1,7 +1,16 @@
 import os
 import boto3
+from functools import lru_cache
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=50 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+
 def fix_endpoint_url_for_docker(endpoint_url: str) -> str:
     if not endpoint_url:
         return endpoint_url
@@ -9,11 +18,19 @@ def fix_endpoint_url_for_docker(endpoint_url: str) -> str:
         endpoint_url = endpoint_url.replace('localhost', 'localstack').replace('127.0.0.1', 'localstack')
     return endpoint_url.rstrip('/')
 
+@lru_cache(maxsize=None)
 def fix_endpoint_url_for_client(endpoint_url: str) -> str:
     if not endpoint_url:
         return endpoint_url
     return endpoint_url.replace('localstack', 'localhost')
 
+@lru_cache(maxsize=None)
+def get_client_endpoint(endpoint_url: str) -> tuple:
+    endpoint_for_client = fix_endpoint_url_for_client(endpoint_url).rstrip('/')
+    is_localstack = any(host in endpoint_for_client for host in ('localhost:4566', 'localstack:4566', '127.0.0.1:4566'))
+    return endpoint_for_client, is_localstack
+
+@lru_cache()
 def get_s3_client():
     endpoint_url = os.getenv('S3_ENDPOINT_URL', 'http://localhost:4566')
     access_key = os.getenv('S3_ACCESS_KEY', 'test')
@@ -27,10 +44,16 @@ def get_s3_client():
         endpoint_url=endpoint_url,
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
-        config=Config(signature_version='s3v4'),
+        config=Config(
+            signature_version='s3v4',
+            max_pool_connections=64,
+            retries={'mode': 'adaptive', 'max_attempts': 5},
+            tcp_keepalive=True
+        ),
         region_name=region
     )
 
+@lru_cache(maxsize=1)
 def get_delta_storage_options() -> dict:
     endpoint_url = os.getenv('S3_ENDPOINT_URL', 'http://localhost:4566')
     access_key = os.getenv('S3_ACCESS_KEY', 'test')
@@ -47,6 +70,7 @@ def get_delta_storage_options() -> dict:
         'AWS_ALLOW_HTTP': 'true',
     }
 
+@lru_cache(maxsize=1)
 def get_bucket_name() -> str:
     bucket_name = os.getenv('S3_BUCKET_NAME', 'test-delta-bucket')
     if not bucket_name:
@@ -20,6 +20,8 @@ class Settings:
     
     JWT_SECRET_KEY: str = os.getenv("JWT_SECRET_KEY", "default-jwt-secret-change-in-production")
     JWT_ALGORITHM: str = os.getenv("JWT_ALGORITHM", "HS256")
+    JWT_PRIVATE_KEY: str = os.getenv("JWT_PRIVATE_KEY", "").replace("\\n", "\n")
+    JWT_PUBLIC_KEY: str = os.getenv("JWT_PUBLIC_KEY", "").replace("\\n", "\n")
     JWT_ACCESS_TOKEN_EXPIRE_MINUTES: int = int(os.getenv("JWT_ACCESS_TOKEN_EXPIRE_MINUTES", "1440"))
     
     ALLOW_INSECURE_DEFAULTS: bool = os.getenv("ALLOW_INSECURE_DEFAULTS", "false").lower() == "true"
@@ -35,9 +37,15 @@ class Settings:
             insecure_defaults.append("TOKEN_SIGNING_SECRET")
         if self.TOKEN_SALT == "default-token-salt-change-in-production":
             insecure_defaults.append("TOKEN_SALT")
-        if self.JWT_SECRET_KEY == "default-jwt-secret-change-in-production":
+        if self.JWT_SECRET_KEY == "default-jwt-secret-change-in-production" and not (self.JWT_PRIVATE_KEY and self.JWT_PUBLIC_KEY):
             insecure_defaults.append("JWT_SECRET_KEY")
         
+        if (self.JWT_PRIVATE_KEY or self.JWT_PUBLIC_KEY) and self.JWT_ALGORITHM.upper().startswith("HS"):
+            raise ValueError(
+                f"JWT_ALGORITHM={self.JWT_ALGORITHM} is symmetric and cannot be used with JWT_PRIVATE_KEY/JWT_PUBLIC_KEY. "
+                "Use an asymmetric algorithm such as ES256 or RS256, or unset the PEM keys."
+            )
+        
         if insecure_defaults and not self.ALLOW_INSECURE_DEFAULTS:
             raise ValueError(
                 f"Insecure default secrets detected: {', '.join(insecure_defaults)}. "
@@ -57,6 +65,16 @@ class Settings:
     def get_token_signing_secret_bytes(cls) -> bytes:
         return cls.TOKEN_SIGNING_SECRET.encode('utf-8')
     
+    @classmethod
+    def get_jwt_signing_key(cls) -> str:
+        if cls.JWT_PUBLIC_KEY and not cls.JWT_PRIVATE_KEY:
+            raise ValueError("JWT_PRIVATE_KEY must be set to sign tokens when JWT_PUBLIC_KEY is set")
+        return cls.JWT_PRIVATE_KEY or cls.JWT_SECRET_KEY
+    
+    @classmethod
+    def get_jwt_verification_key(cls) -> str:
+        return cls.JWT_PUBLIC_KEY or cls.JWT_SECRET_KEY
+    
     @classmethod
     def get_token_salt_bytes(cls) -> bytes:
         return cls.TOKEN_SALT.encode('utf-8')
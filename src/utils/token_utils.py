@@ -1,3 +1,5 @@
+import base64
+import binascii
 import hashlib
 import hmac
 import secrets
@@ -12,10 +14,39 @@ def hash_token(token: str) -> str:
         raise ValueError("Token salt must be bytes")
     return hmac.new(salt, token.encode('utf-8'), hashlib.sha256).hexdigest()
 
+SHARE_TOKEN_BYTES = 36
+SHARE_TOKEN_CHECKSUM_BYTES = 5
+
+def compute_token_checksum(raw_token: bytes) -> bytes:
+    settings = get_settings()
+    return hmac.new(settings.get_token_salt_bytes(), raw_token, hashlib.blake2b).digest()[:SHARE_TOKEN_CHECKSUM_BYTES]
+
 def generate_share_token() -> str:
-    token_string = secrets.token_urlsafe(32)
-    checksum = hashlib.sha256(token_string.encode()).hexdigest()[:8]
-    return f"{token_string}-{checksum}"
+    raw_token = secrets.token_bytes(SHARE_TOKEN_BYTES)
+    return base64.urlsafe_b64encode(raw_token + compute_token_checksum(raw_token)).rstrip(b"=").decode()
+
+def verify_legacy_share_token(token: str) -> Optional[str]:
+    token_string, _, checksum = token.rpartition("-")
+    if not token_string:
+        return None
+    settings = get_settings()
+    keyed_checksum = hmac.new(settings.get_token_salt_bytes(), token_string.encode('utf-8'), hashlib.sha256).hexdigest()[:8]
+    if hmac.compare_digest(checksum, keyed_checksum):
+        return token_string
+    if hmac.compare_digest(checksum, hashlib.sha256(token_string.encode()).hexdigest()[:8]):
+        return token_string
+    return None
+
+def verify_share_token(token: str) -> Optional[str]:
+    try:
+        decoded = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, binascii.Error):
+        decoded = b""
+    if len(decoded) == SHARE_TOKEN_BYTES + SHARE_TOKEN_CHECKSUM_BYTES:
+        raw_token, checksum = decoded[:SHARE_TOKEN_BYTES], decoded[SHARE_TOKEN_BYTES:]
+        if hmac.compare_digest(checksum, compute_token_checksum(raw_token)):
+            return token
+    return verify_legacy_share_token(token)
 
 def verify_token_hash(token: str, stored_hash: str) -> bool:
     computed_hash = hash_token(token)
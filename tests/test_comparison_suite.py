@@ -22,7 +22,7 @@ from delta_sharing.protocol import DeltaSharingProfile
 from src.utils.s3_utils import get_s3_client, get_bucket_name, get_delta_storage_options, get_full_s3_path
 from src.models.database import SessionLocal, User
 from src.utils.settings import get_settings
-from tests.utils import api_post, api_get, api_delete
+from tests.utils import api_post, api_get, api_get_all_pages, api_delete
 
 MARKETPLACE_URL = os.getenv("MARKETPLACE_URL", "http://localhost:8000")
 DELTA_SHARING_SERVER_URL = os.getenv("DELTA_SHARING_SERVER_URL", "http://localhost:8080")
@@ -188,7 +188,7 @@ def _test_delta_sharing_delivery(
         share_id = purchase_data["share_id"]
     except Exception as e:
         if "already have access" in str(e).lower():
-            shares = api_get(f"{MARKETPLACE_URL}/my-shares", headers=buyer_headers)
+            shares = api_get_all_pages(f"{MARKETPLACE_URL}/my-shares", headers=buyer_headers)
             share = next((s for s in shares if s["dataset_id"] == dataset_id), None)
             if share:
                 share_id = share["id"]
@@ -273,7 +273,7 @@ def _test_file_download_delivery(
             share_id = purchase_data["share_id"]
         except Exception as e:
             if "already have access" in str(e).lower():
-                shares = api_get(f"{MARKETPLACE_URL}/my-shares", headers=buyer_headers)
+                shares = api_get_all_pages(f"{MARKETPLACE_URL}/my-shares", headers=buyer_headers)
                 share = next((s for s in shares if s["dataset_id"] == dataset_id), None)
                 if share:
                     share_id = share["id"]
@@ -343,7 +343,7 @@ def _test_revocation(
             api_post(f"{MARKETPLACE_URL}/shares/{share_id}/approve", {}, headers=seller_headers)
         except Exception as e:
             if "already have access" in str(e).lower():
-                shares = api_get(f"{MARKETPLACE_URL}/my-shares", headers=buyer_headers)
+                shares = api_get_all_pages(f"{MARKETPLACE_URL}/my-shares", headers=buyer_headers)
                 share = next((s for s in shares if s["dataset_id"] == dataset_id), None)
                 if share:
                     share_id = share["id"]
@@ -19,7 +19,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from src.models.database import SessionLocal, Dataset, User
 from src.seller.data_writer import write_data_continuously
 from src.utils.s3_utils import get_s3_client, get_bucket_name, get_delta_storage_options, get_full_s3_path
-from tests.utils import check_watermark, extract_list_items, api_post, api_get, api_delete
+from tests.utils import check_watermark, extract_list_items, api_post, api_get, api_get_all_pages, api_delete
 
 MARKETPLACE_URL = os.getenv("MARKETPLACE_URL", "http://localhost:8000")
 DELTA_SHARING_SERVER_URL = os.getenv("DELTA_SHARING_SERVER_URL", "http://localhost:8080")
@@ -316,7 +316,7 @@ def test_e2e_delta_sharing():
             print(f"  [WARN] WARNING: Watermark not detected in final query: {result.get('reason', 'Unknown reason')}")
         
         print("\n[12] Testing usage logging...")
-        logs = api_get(f"{MARKETPLACE_URL}/usage-logs?dataset_id={dataset_id}", headers=seller_headers)
+        logs = api_get_all_pages(f"{MARKETPLACE_URL}/usage-logs?dataset_id={dataset_id}", headers=seller_headers)
         print(f"[OK] Found {len(logs)} usage log entries")
         if len(logs) > 0:
             latest_log = logs[0]
@@ -325,7 +325,7 @@ def test_e2e_delta_sharing():
             print(f"  Columns requested: {latest_log['columns_requested']}")
         
         print("\n[13] Testing share revocation...")
-        shares_list = api_get(f"{MARKETPLACE_URL}/my-shares", headers=seller_headers)
+        shares_list = api_get_all_pages(f"{MARKETPLACE_URL}/my-shares", headers=seller_headers)
         test_share = next((s for s in shares_list if s["id"] == share_id), None)
         assert test_share is not None, "Share not found in seller's shares"
         assert test_share["revoked"] == False, "Share should not be revoked yet"
@@ -1017,7 +1017,7 @@ def test_phase2_filtering():
     print(f"    [OK] Invalid table name correctly rejected (status {response.status_code})")
     
     print("\n[10] Testing revoked share blocks filtered queries...")
-    shares_list = api_get(f"{MARKETPLACE_URL}/my-shares", headers=seller_headers)
+    shares_list = api_get_all_pages(f"{MARKETPLACE_URL}/my-shares", headers=seller_headers)
     test_share = next((s for s in shares_list if s["id"] == share_id), None)
     if test_share:
         api_delete(f"{MARKETPLACE_URL}/shares/{share_id}", headers=seller_headers)
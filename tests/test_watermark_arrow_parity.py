@@ -0,0 +1,65 @@
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('ALLOW_INSECURE_DEFAULTS', 'true')
+
+from src.seller.watermarking import (
+    generate_watermark, compute_row_anchor, compute_row_anchors_arrow,
+    apply_watermark_to_dataframe, apply_watermark_to_arrow_table
+)
+
+def _mixed_table() -> pa.Table:
+    return pa.table({
+        'id': pa.array([1, 2, 3, 4, 5], type=pa.int64()),
+        'customer_key': pa.array([10, None, 30, 40, None], type=pa.int64()),
+        'amount': pa.array([1.5, None, 3.25, float('nan'), 0.1], type=pa.float64()),
+        'status': pa.array(['new', None, 'paid', 'paid', 'refunded'], type=pa.string()),
+        'is_active': pa.array([True, False, True, True, False], type=pa.bool_()),
+        'flagged': pa.array([True, None, False, None, True], type=pa.bool_()),
+        'created_at': pa.array([
+            datetime(2024, 1, 1, 10, 0, 0, 123456),
+            None,
+            datetime(2024, 2, 29, 23, 59, 59, 999999),
+            datetime(2023, 12, 31, 0, 0, 0),
+            datetime(2024, 6, 15, 12, 30, 45, 500000)
+        ], type=pa.timestamp('us')),
+        'event_time': pa.array([
+            '2024-01-01T10:00:00.123456',
+            '2024-01-02T11:30:00.000000',
+            None,
+            '2024-03-01T00:00:00.000001',
+            '2024-03-02T08:15:30.250000'
+        ], type=pa.string())
+    })
+
+@pytest.mark.parametrize('anchor_columns', [None, ['id', 'status'], ['customer_key', 'amount', 'flagged', 'created_at']])
+def test_arrow_row_anchors_match_pandas(anchor_columns):
+    table = _mixed_table()
+    df = table.to_pandas()
+    
+    expected = df.apply(lambda r: compute_row_anchor(r, df.dtypes, anchor_columns), axis=1).values.astype(np.uint64)
+    actual = compute_row_anchors_arrow(table, anchor_columns)
+    
+    np.testing.assert_array_equal(actual, expected)
+
+@pytest.mark.parametrize('is_trial', [False, True])
+@pytest.mark.parametrize('anchor_columns', [None, ['id', 'status']])
+def test_arrow_watermark_matches_pandas(is_trial, anchor_columns):
+    table = _mixed_table()
+    watermark = generate_watermark(7, 42)
+    
+    expected = apply_watermark_to_dataframe(table.to_pandas(), watermark, is_trial=is_trial, anchor_columns=anchor_columns)
+    actual = apply_watermark_to_arrow_table(table, watermark, is_trial=is_trial, anchor_columns=anchor_columns).to_pandas()
+    
+    assert list(actual.columns) == list(expected.columns)
+    for col in ('created_at', 'event_time'):
+        expected[col] = pd.to_datetime(expected[col]).astype('datetime64[ns]')
+        actual[col] = pd.to_datetime(actual[col]).astype('datetime64[ns]')
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)